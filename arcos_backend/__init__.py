@@ -1,3 +1,5 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from slowapi import Limiter, _rate_limit_exceeded_handler
@@ -7,12 +9,17 @@ from slowapi.errors import RateLimitExceeded
 from . import _shared as shared; shared.init()  # NOQA E701
 from ._shared import configuration as cfg
 from .davult import models
-from .davult.database import engine
+from .davult.database import engine, read_engine, async_engine, async_read_engine, LocalSession
+from .davult.buffer import properties_buffer
+from .davult.migrations import migrate
+from .davult.reaper import SessionReaper
 from .filesystem import Filesystem
 from .routers import TAGS_DOCS
 from .routers.v1 import meta, token, user, users, filesystem, messages, admin
 from ._authentication import AuthCodeMiddleware
-from ._logging import LoggingMiddleware
+from ._logging import AccessLog, LoggingMiddleware
+from ._limits import BodySizeLimitMiddleware
+from ._metrics import MetricsMiddleware, instrument_engine
 
 
 def get_cfg():
@@ -20,12 +27,37 @@ def get_cfg():
 
 
 models.Base.metadata.create_all(bind=engine)
+migrate(engine)
+
+if cfg['metrics']['enabled']:
+    for instrumented_engine in (engine, read_engine, async_engine, async_read_engine):
+        if instrumented_engine is not None:
+            instrument_engine(getattr(instrumented_engine, 'sync_engine', instrumented_engine))
+
+session_reaper = SessionReaper(LocalSession, cfg['security']['session_reaper']['interval'], cfg['security']['session_reaper']['batch_size'])
+access_log = AccessLog(**{key: value for key, value in cfg['logging'].items() if key != 'sampling'})
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    access_log.start()
+    session_reaper.start()
+    properties_buffer.start()
+    yield
+    properties_buffer.stop()
+    session_reaper.stop()
+    await async_engine.dispose()
+    if async_read_engine is not None:
+        await async_read_engine.dispose()
+    access_log.stop()
+
 
 limiter = Limiter(key_func=get_remote_address)
 app = FastAPI(
     title=cfg['info']['name'],
     version="always evolving :b",
-    openapi_tags=TAGS_DOCS
+    openapi_tags=TAGS_DOCS,
+    lifespan=lifespan
 )
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
@@ -45,9 +77,19 @@ app.add_middleware(
 )
 
 app.add_middleware(
-    LoggingMiddleware
+    BodySizeLimitMiddleware,
+    limits=cfg['security']['max_body_size']
 )
 
+app.add_middleware(
+    LoggingMiddleware,
+    access_log=access_log,
+    sampling=cfg['logging']['sampling']
+)
+
+if cfg['metrics']['enabled']:
+    app.add_middleware(MetricsMiddleware)
+
 
 app.include_router(meta.router)
 app.include_router(token.router)
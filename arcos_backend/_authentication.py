@@ -1,24 +1,37 @@
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
+from urllib.parse import unquote_plus
+
 from starlette.responses import Response
+from starlette.types import ASGIApp, Scope, Receive, Send
 
 EXCLUDED_ENDPOINTS = ['/connect']
 
 
-class AuthCodeMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, authcode: str):
-        super().__init__(app)
+class AuthCodeMiddleware:
+    def __init__(self, app: ASGIApp, authcode: str):
+        self.app = app
 
         self._authcode = authcode
 
-    async def dispatch(self, request: Request, call_next):
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
         if (
+                scope['type'] == 'http' and
                 self._authcode is not None and
-                request.scope['path'] not in EXCLUDED_ENDPOINTS
+                scope['path'] not in EXCLUDED_ENDPOINTS and
+                _get_query_parameter(scope['query_string'], b'ac') != self._authcode
         ):
-            params = request.query_params
+            await Response(status_code=401)(scope, receive, send)
+            return
+
+        await self.app(scope, receive, send)
+
+
+def _get_query_parameter(query_string: bytes, name: bytes) -> str | None:
+    value = None
 
-            if 'ac' not in params or params['ac'] != self._authcode:
-                return Response(status_code=401)
+    # the last occurrence wins, same as with `request.query_params`
+    for parameter in query_string.split(b'&'):
+        key, _, raw_value = parameter.partition(b'=')
+        if unquote_plus(key.decode('latin-1')) == name.decode('latin-1'):
+            value = unquote_plus(raw_value.decode('latin-1'))
 
-        return await call_next(request)
+    return value
@@ -0,0 +1,140 @@
+import copy
+
+# JSON pointers (RFC 6901) and JSON patches (RFC 6902)
+# malformed pointers and operations raise `ValueError`, paths that don't exist and failed tests `LookupError`
+
+
+def parse_pointer(pointer: str) -> list[str]:
+    if pointer == '':
+        return []
+
+    if not pointer.startswith('/'):
+        raise ValueError(f"invalid JSON pointer {pointer!r}")
+
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+
+def resolve_pointer(document, pointer: str | list[str]):
+    for token in parse_pointer(pointer) if isinstance(pointer, str) else pointer:
+        if isinstance(document, dict):
+            if token not in document:
+                raise LookupError(f"{token!r} doesn't exist")
+            document = document[token]
+        elif isinstance(document, list):
+            document = document[_parse_index(token, len(document))]
+        else:
+            raise LookupError(f"{token!r} doesn't exist")
+
+    return document
+
+
+def apply_patch(document, operations: list) -> object:
+    if not isinstance(operations, list):
+        raise ValueError("patch has to be a list of operations")
+
+    # operations are applied to a copy, so that a failing patch leaves the document untouched
+    document = copy.deepcopy(document)
+
+    for operation in operations:
+        if not isinstance(operation, dict) or not isinstance(operation.get('op'), str) or not isinstance(operation.get('path'), str):
+            raise ValueError(f"invalid operation {operation!r}")
+
+        op, path = operation['op'], parse_pointer(operation['path'])
+
+        if op == 'add':
+            document = _add(document, path, _get_value(operation))
+        elif op == 'remove':
+            document, _ = _remove(document, path)
+        elif op == 'replace':
+            value = _get_value(operation)
+            document, _ = _remove(document, path) if path else (document, None)
+            document = _add(document, path, value)
+        elif op in ('move', 'copy'):
+            if not isinstance(operation.get('from'), str):
+                raise ValueError(f"invalid operation {operation!r}")
+            source = parse_pointer(operation['from'])
+
+            if op == 'move':
+                if path[:len(source)] == source and path != source:
+                    raise ValueError("can't move a value into itself")
+                document, value = _remove(document, source)
+            else:
+                value = copy.deepcopy(resolve_pointer(document, source))
+
+            document = _add(document, path, value)
+        elif op == 'test':
+            if not _is_equal(resolve_pointer(document, path), _get_value(operation)):
+                raise LookupError(f"test of {operation['path']!r} failed")
+        else:
+            raise ValueError(f"unknown operation {op!r}")
+
+    return document
+
+
+def _add(document, path: list[str], value):
+    if not path:
+        return value
+
+    parent, token = resolve_pointer(document, path[:-1]), path[-1]
+
+    if isinstance(parent, dict):
+        parent[token] = value
+    elif isinstance(parent, list):
+        parent.insert(_parse_index(token, len(parent), allow_end=True), value)
+    else:
+        raise LookupError(f"{token!r} can't be added")
+
+    return document
+
+
+def _remove(document, path: list[str]) -> tuple[object, object]:
+    if not path:
+        raise ValueError("can't remove the whole document")
+
+    parent, token = resolve_pointer(document, path[:-1]), path[-1]
+
+    if isinstance(parent, dict):
+        if token not in parent:
+            raise LookupError(f"{token!r} doesn't exist")
+        value = parent.pop(token)
+    elif isinstance(parent, list):
+        value = parent.pop(_parse_index(token, len(parent)))
+    else:
+        raise LookupError(f"{token!r} doesn't exist")
+
+    return document, value
+
+
+def _parse_index(token: str, size: int, allow_end: bool = False) -> int:
+    if token == '-' and allow_end:
+        return size
+
+    if not token.isdigit() or (token.startswith('0') and token != '0'):
+        raise LookupError(f"{token!r} isn't an array index")
+
+    if (index := int(token)) > size or (index == size and not allow_end):
+        raise LookupError(f"index {index} is out of range")
+
+    return index
+
+
+def _get_value(operation: dict):
+    if 'value' not in operation:
+        raise ValueError(f"operation {operation['op']!r} needs a value")
+
+    return operation['value']
+
+
+def _is_equal(a, b) -> bool:
+    # python considers `1 == 1.0 == True`, JSON doesn't consider booleans numbers
+    if isinstance(a, bool) or isinstance(b, bool):
+        return type(a) is type(b) and a == b
+
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(_is_equal(a[key], b[key]) for key in a)
+
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(_is_equal(x, y) for x, y in zip(a, b))
+
+    is_comparable = type(a) is type(b) or (isinstance(a, (int, float)) and isinstance(b, (int, float)))
+    return is_comparable and a == b
@@ -0,0 +1,37 @@
+from starlette.exceptions import HTTPException
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Scope, Receive, Send
+
+
+class BodySizeLimitMiddleware:
+    def __init__(self, app: ASGIApp, limits: dict[str, int | None]):
+        self.app = app
+
+        self._limits = {path: limit for path, limit in limits.items() if limit is not None}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or (limit := self._limits.get(scope['path'])) is None:
+            await self.app(scope, receive, send)
+            return
+
+        for key, value in scope['headers']:
+            if key == b'content-length' and value.isdigit() and int(value) > limit:
+                await Response(status_code=413)(scope, receive, send)
+                return
+
+        received = 0
+
+        # content length may be missing (chunked encoding) or lie, so the body is counted as it arrives
+        async def receive_wrapper() -> Message:
+            nonlocal received
+
+            message = await receive()
+
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    raise HTTPException(status_code=413)
+
+            return message
+
+        await self.app(scope, receive_wrapper, send)
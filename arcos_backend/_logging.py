@@ -1,69 +1,161 @@
-from typing import Callable, Awaitable
-import time
-import logging
-import logging.handlers
+import gzip
+import json
+import os
 import queue
-import http
-
-from starlette.exceptions import HTTPException
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
-from starlette.responses import Response
-
-
-class LoggingMiddleware(BaseHTTPMiddleware):
-    _filename: str
-    _logger: logging.Logger
-    _logging_queue: queue.Queue
-    _queue_handler: logging.handlers.QueueHandler
-    _queue_listener: logging.handlers.QueueListener
-    _handler: logging.FileHandler
-
-    def __init__(self, app, filename: str = "stuff.log"):
-        super().__init__(app)
-
-        self._filename = filename
-
-        self._logger = logging.getLogger("arcos_backend")
-        self._logger.setLevel(logging.INFO)
-
-        self._logging_queue = queue.Queue()
-        self._queue_handler = logging.handlers.QueueHandler(self._logging_queue)
-        self._logger.addHandler(self._queue_handler)
-
-        self._handler = logging.FileHandler(self._filename)
-        self._handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s - %(message)s"))
-
-        self._queue_listener = logging.handlers.QueueListener(self._logging_queue, self._handler)
-        self._queue_listener.start()  # XXX should it be stoppable?
+import random
+import shutil
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from starlette.types import ASGIApp, Message, Scope, Receive, Send
+
+
+class AccessLog:
+    _path: Path
+    _max_bytes: int | None
+    _rotation_interval: float | None
+    _backups: int
+    _batch_size: int
+    _flush_interval: float
+    _queue: queue.SimpleQueue
+    _thread: threading.Thread | None
+    _opened_time: float
+
+    def __init__(self, filename: str, max_bytes: int | None = None, rotation_interval: float | None = None,
+                 backups: int = 7, batch_size: int = 256, flush_interval: float = 1.0):
+        self._path = Path(filename)
+        self._max_bytes = max_bytes
+        self._rotation_interval = rotation_interval
+        self._backups = backups
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._opened_time = time.time()
+
+    def log(self, record: dict):
+        self._queue.put(record)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="access-log", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        # `None` tells the writer to flush everything queued before it and exit
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        file = self._path.open('a', encoding='utf-8')
+        is_running = True
+
+        while is_running:
+            try:
+                batch = [self._queue.get(timeout=self._flush_interval)]
+            except queue.Empty:
+                batch = []
+
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                batch = batch[:batch.index(None)]
+                is_running = False
+
+            if batch:
+                file.write(''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in batch))
+                file.flush()
+
+            if self._should_rotate(file):
+                file.close()
+                self._rotate()
+                file = self._path.open('a', encoding='utf-8')
+
+        file.close()
+
+    def _should_rotate(self, file) -> bool:
+        return (
+            (self._max_bytes is not None and file.tell() >= self._max_bytes) or
+            (self._rotation_interval is not None and time.time() - self._opened_time >= self._rotation_interval)
+        )
+
+    def _rotate(self):
+        # unique even for rotations within the same second, or by other workers sharing the log
+        rotated_path = self._path.with_name(f"{self._path.name}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{os.getpid()}")
+        os.replace(self._path, rotated_path)
+
+        with rotated_path.open('rb') as source, gzip.open(rotated_path.with_name(f"{rotated_path.name}.gz"), 'wb') as destination:
+            shutil.copyfileobj(source, destination)
+        rotated_path.unlink()
+
+        self._opened_time = time.time()
+
+        # the timestamps in names sort chronologically
+        for stale_path in sorted(self._path.parent.glob(f"{self._path.name}.*.gz"))[:-self._backups or None]:
+            stale_path.unlink()
+
+
+class LoggingMiddleware:
+    _access_log: AccessLog
+    _sampling: dict[str, float]
+
+    def __init__(self, app: ASGIApp, access_log: AccessLog, sampling: dict[str, float] | None = None):
+        self.app = app
+
+        self._access_log = access_log
+        self._sampling = sampling or {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
 
-    async def dispatch(self, request: Request, call_next: Callable[[Request], Awaitable[Response]]) -> Response:
         callback_time_start = time.perf_counter()
+        status_code = 500
+        sent_bytes = 0
+        error = None
 
-        base_msg = f"{(c := request.client)[0]}:{c[1]} - {request.method} {request.url.path} - "
+        async def send_wrapper(message: Message):
+            nonlocal status_code, sent_bytes
 
-        def time_taken() -> str:
-            nonlocal callback_time_start, callback_time_end
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            elif message['type'] == 'http.response.body':
+                sent_bytes += len(message.get('body', b''))
 
-            return f" - {(callback_time_end - callback_time_start) * 1000:.2f}ms"
+            await send(message)
 
         try:
-            response = await call_next(request)
-        except HTTPException as http_exc:
-            callback_time_end = time.perf_counter()
-
-            self._logger.warning(base_msg + f"{(code := http_exc.status_code)} {http.HTTPStatus(code).phrase}{f' ({http_exc.detail})' if http_exc.detail is not None else ''}" + time_taken())
-
-            raise http_exc from http_exc.__context__
+            await self.app(scope, receive, send_wrapper)
         except Exception as exc:
-            callback_time_end = time.perf_counter()
-
-            self._logger.warning(base_msg + f"500 Internal Server Error ({type(exc).__name__}: {exc})" + time_taken())
+            status_code = 500
+            error = f"{type(exc).__name__}: {exc}"
 
             raise exc from exc.__context__
-        else:
-            callback_time_end = time.perf_counter()
-
-            self._logger.info(base_msg + f"{(code := response.status_code)} {http.HTTPStatus(code).phrase}" + time_taken())
-
-            return response
+        finally:
+            # the route is only known after routing, raw path is used for unmatched requests
+            path = getattr(scope.get('route'), 'path', scope['path'])
+
+            if not (200 <= status_code < 300 and random.random() >= self._sampling.get(path, 1.0)):
+                client = scope.get('client') or ('-', 0)
+
+                self._access_log.log({
+                    'time': time.time(),
+                    'client': f"{client[0]}:{client[1]}",
+                    'method': scope['method'],
+                    'path': path,
+                    'status': status_code,
+                    'duration': round((time.perf_counter() - callback_time_start) * 1000, 2),
+                    'bytes': sent_bytes,
+                    'user': scope.get('state', {}).get('user_id'),
+                    **({'error': error} if error is not None else {})
+                })
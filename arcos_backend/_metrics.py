@@ -0,0 +1,249 @@
+import bisect
+import contextvars
+import threading
+import time
+import weakref
+from typing import Callable, TypeVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Message, Scope, Receive, Send
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+M = TypeVar('M', bound='_Metric')
+
+
+class _Metric:
+    # every thread updates only its own shard, so the hot path needs no locks; shards are summed when rendering,
+    # and those of finished threads are folded into the base one, so that recycled workers don't pile them up
+    name: str
+    description: str
+    labels: tuple[str, ...]
+    _local: threading.local
+    _shards: dict[int, dict]
+    _base: dict
+    _lock: threading.Lock
+
+    type: str
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._local = threading.local()
+        self._shards = {}
+        self._base = {}
+        self._lock = threading.Lock()
+
+    def _get_shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            # dropped along with the rest of the thread's locals once it finishes
+            self._local.owner = owner = _ShardOwner()
+            weakref.finalize(owner, self._fold, shard)
+
+            with self._lock:
+                self._shards[id(shard)] = shard
+            return shard
+
+    def _fold(self, shard: dict):
+        with self._lock:
+            del self._shards[id(shard)]
+            self._merge(self._base, shard)
+
+    def _collect(self) -> list[dict]:
+        with self._lock:
+            return [self._copy(shard) for shard in (self._base, *self._shards.values())]
+
+    def _copy(self, shard: dict) -> dict:
+        return shard.copy()
+
+    def _merge(self, total: dict, shard: dict):
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        raise NotImplementedError
+
+
+class _ShardOwner:
+    pass
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *label_values: str, amount: float = 1):
+        shard = self._get_shard()
+        shard[label_values] = shard.get(label_values, 0) + amount
+
+    def _merge(self, total: dict, shard: dict):
+        for label_values, value in shard.items():
+            total[label_values] = total.get(label_values, 0) + value
+
+    def render(self) -> list[str]:
+        values = {}
+        for shard in self._collect():
+            self._merge(values, shard)
+
+        return [f"{self.name}{_format_labels(self.labels, label_values)} {value}" for label_values, value in values.items()]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, *label_values: str, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+
+class CallbackMetric(_Metric):
+    # for values that are already counted elsewhere, read only when rendering
+    _callback: Callable[[], float]
+
+    def __init__(self, name: str, description: str, callback: Callable[[], float], type: str = 'gauge'):
+        super().__init__(name, description)
+        self._callback = callback
+        self.type = type
+
+    def render(self) -> list[str]:
+        return [f"{self.name} {self._callback()}"]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+    _buckets: tuple[float, ...]
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self._buckets = buckets
+
+    def observe(self, value: float, *label_values: str):
+        shard = self._get_shard()
+
+        # bucket counts (the last one is +Inf), then sum
+        if (state := shard.get(label_values)) is None:
+            state = shard[label_values] = [0] * (len(self._buckets) + 2)
+
+        state[bisect.bisect_left(self._buckets, value)] += 1
+        state[-1] += value
+
+    def _copy(self, shard: dict) -> dict:
+        return {label_values: state.copy() for label_values, state in shard.copy().items()}
+
+    def _merge(self, total: dict, shard: dict):
+        for label_values, state in shard.items():
+            if (current := total.get(label_values)) is None:
+                total[label_values] = state.copy()
+            else:
+                total[label_values] = [a + b for a, b in zip(current, state)]
+
+    def render(self) -> list[str]:
+        states = {}
+        for shard in self._collect():
+            self._merge(states, shard)
+
+        lines = []
+        for label_values, state in states.items():
+            cumulative = 0
+            for bound, count in zip((*self._buckets, '+Inf'), state):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels((*self.labels, 'le'), (*label_values, bound))} {cumulative}")
+
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {state[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {cumulative}")
+
+        return lines
+
+
+class MetricsRegistry:
+    _metrics: list[_Metric]
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: M) -> M:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ''
+
+    escape = lambda value: str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')  # NOQA E731
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+metrics = MetricsRegistry()
+
+request_duration = metrics.register(Histogram("arcapi_request_duration_seconds", "Request latency per route", ('method', 'route')))
+requests_total = metrics.register(Counter("arcapi_requests_total", "Finished requests per route and status code", ('method', 'route', 'status')))
+requests_in_flight = metrics.register(Gauge("arcapi_requests_in_flight", "Requests currently being handled"))
+sql_queries_per_request = metrics.register(Histogram("arcapi_sql_queries_per_request", "SQL queries issued per request", ('route',), QUERY_COUNT_BUCKETS))
+sql_query_duration = metrics.register(Histogram("arcapi_sql_query_duration_seconds", "SQL query latency"))
+filesystem_bytes = metrics.register(Counter("arcapi_filesystem_bytes_total", "Bytes read or written in userspaces per operation", ('operation',)))
+
+# SQL queries of the current request, shared with the threadpool workers through the copied context
+_request_queries: contextvars.ContextVar[list[int] | None] = contextvars.ContextVar('request_queries', default=None)
+
+
+def instrument_engine(engine: Engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info['query_start'] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        sql_query_duration.observe(time.perf_counter() - connection.info.pop('query_start'))
+
+        if (queries := _request_queries.get()) is not None:
+            queries[0] += 1
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+        queries = [0]
+        token = _request_queries.set(queries)
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+
+            await send(message)
+
+        requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            requests_in_flight.dec()
+            _request_queries.reset(token)
+
+            route = getattr(scope.get('route'), 'path', None) or 'unmatched'  # raw paths would blow up the label count
+
+            request_duration.observe(time.perf_counter() - start, scope['method'], route)
+            requests_total.inc(scope['method'], route, str(status_code))
+            sql_queries_per_request.observe(queries[0], route)
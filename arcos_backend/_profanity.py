@@ -0,0 +1,108 @@
+import importlib.util
+import os
+
+# besides alphanumerics these are considered a part of the word, same as in `better_profanity`
+WORD_CHARACTERS = frozenset("@$*\"'")
+# stands for any run of separators in the entries
+SEPARATOR = ' '
+# what each character can stand for, itself included, as the wordlists have leetspeak entries too (everything else stands only for itself)
+LEETSPEAK = {
+    '@': '@ao',
+    '*': '*aiouve',
+    '4': '4a',
+    '1': '1il',
+    'l': 'li',
+    '0': '0o',
+    'u': 'uv',
+    'v': 'vu',
+    '3': '3e',
+    '$': '$s',
+    '5': '5s',
+    '7': '7t'
+}
+
+
+class ProfanityMatcher:
+    _transitions: list[dict[str, int]]
+    _terminals: dict[int, bool]
+
+    def __init__(self, substrings: list[str], words: list[str]):
+        self._transitions = [{}]
+        # node -> whether it only matches whole words
+        self._terminals = {}
+
+        for word in words:
+            self._add(word, True)
+        for substring in substrings:
+            self._add(substring, False)
+
+    def contains_profanity(self, text: str) -> bool:
+        text = text.lower()
+        # (node, whether the match has started at the beginning of a word)
+        active = set()
+
+        for index, char in enumerate(text):
+            if not _is_word_character(char):
+                # a run of separators continues only the entries spelled with one there ("blow job" matches "blow_job" too)
+                if index > 0 and _is_word_character(text[index - 1]):
+                    active = {(next_node, started_at_word) for node, started_at_word in active
+                              if (next_node := self._transitions[node].get(SEPARATOR)) is not None}
+                continue
+
+            is_word_start = index == 0 or not _is_word_character(text[index - 1])
+            is_word_end = index == len(text) - 1 or not _is_word_character(text[index + 1])
+
+            active.add((0, is_word_start))
+            advanced = set()
+
+            for node, started_at_word in active:
+                for letter in LEETSPEAK.get(char, char):
+                    if (next_node := self._transitions[node].get(letter)) is None:
+                        continue
+
+                    if (whole_word := self._terminals.get(next_node)) is not None:
+                        if not whole_word or (started_at_word and is_word_end):
+                            return True
+
+                    advanced.add((next_node, started_at_word))
+
+            active = advanced
+
+        return False
+
+    def _add(self, word: str, whole_word: bool):
+        node = 0
+        # separators within the entry, any run of them collapsed into one
+        chars = [char if _is_word_character(char) else SEPARATOR for char in word.lower().strip()]
+        chars = [char for index, char in enumerate(chars) if char != SEPARATOR or (0 < index and chars[index - 1] != SEPARATOR)]
+
+        while chars and chars[-1] == SEPARATOR:
+            chars.pop()
+
+        for char in chars:
+            if (next_node := self._transitions[node].get(char)) is None:
+                next_node = self._transitions[node][char] = len(self._transitions)
+                self._transitions.append({})
+
+            node = next_node
+
+        # substring matches are more strict than whole word ones
+        self._terminals[node] = self._terminals.get(node, True) and whole_word
+
+
+def _is_word_character(char: str) -> bool:
+    return char.isalnum() or char in WORD_CHARACTERS
+
+
+def _read_wordlist(package: str, *path: str) -> list[str]:
+    # located without importing the package, as both build their (huge) word sets on import
+    location = importlib.util.find_spec(package).submodule_search_locations[0]
+
+    with open(os.path.join(location, *path), encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+profanity_matcher = ProfanityMatcher(
+    substrings=_read_wordlist('profanity', 'data', 'wordlist.txt'),
+    words=_read_wordlist('better_profanity', 'profanity_wordlist.txt')
+)
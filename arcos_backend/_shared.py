@@ -24,14 +24,27 @@ def init():
         _is_initialized = True
 
     # load config file, create it if not found
+    default_path = os.path.join("arcos_backend", "assets", "default", "config.default.yaml")
     if not os.path.isfile("config.yaml"):
-        shutil.copy(os.path.join("arcos_backend", "assets", "default", "config.default.yaml"), "config.yaml")
+        shutil.copy(default_path, "config.yaml")
     with open("config.yaml") as f:
         configuration = yaml.safe_load(f)
 
+    # options added after the config file was created fall back to their defaults
+    with open(default_path) as f:
+        _fill_defaults(configuration, yaml.safe_load(f))
+
     storage_cfg = configuration['storage']
     os.makedirs(storage_cfg['root'], exist_ok=True)
 
     filesystem = Filesystem(os.path.join(storage_cfg['root'], storage_cfg['filesystem']),
                             os.path.join(storage_cfg['root'], storage_cfg['template']) if storage_cfg['template'] is not None else None,
                             configuration['filesystem']['userspace_size'])
+
+
+def _fill_defaults(config: dict, defaults: dict):
+    for key, value in defaults.items():
+        if key not in config:
+            config[key] = value
+        elif isinstance(value, dict) and isinstance(config[key], dict):
+            _fill_defaults(config[key], value)
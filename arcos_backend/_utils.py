@@ -1,8 +1,16 @@
+import asyncio
 import hashlib
-from better_profanity import profanity as better_profanity
-from profanity import profanity
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from ._profanity import profanity_matcher
+from ._shared import configuration as cfg
 
 MAX_USERNAME_LEN = 25
+SCRYPT_PREFIX = 'scrypt'
+SCRYPT_SALT_LEN = 16
+SCRYPT_HASH_LEN = 64
 
 
 def validate_username(username: str) -> bool:
@@ -12,9 +20,53 @@ def validate_username(username: str) -> bool:
 
 
 def check_profanity(username: str) -> bool:
-    return profanity.contains_profanity(username) or better_profanity.contains_profanity(username)
+    return profanity_matcher.contains_profanity(username)
 
 
 def hash_salty(password: str) -> str:
     salt = hashlib.shake_128(password.encode('utf-8')).hexdigest(32)
     return hashlib.sha512((salt + password).encode('utf-8'), usedforsecurity=True).hexdigest()
+
+
+class PasswordHasher:
+    _n: int
+    _r: int
+    _p: int
+    _pool: ThreadPoolExecutor
+
+    def __init__(self, n: int, r: int, p: int, workers: int):
+        self._n = n
+        self._r = r
+        self._p = p
+        # scrypt is memory-hard and releases the GIL, so the pool bounds both memory and CPU spent on it
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hasher")
+
+    async def hash(self, password: str) -> str:
+        salt = os.urandom(SCRYPT_SALT_LEN)
+        digest = await self._scrypt(password, salt, self._n, self._r, self._p)
+
+        return f"{SCRYPT_PREFIX}${self._n}${self._r}${self._p}${salt.hex()}${digest.hex()}"
+
+    async def verify(self, hashed_password: str, password: str) -> tuple[bool, bool]:
+        # returns whether the password is valid and whether its hash should be upgraded
+        if not hashed_password.startswith(f"{SCRYPT_PREFIX}$"):
+            return hmac.compare_digest(hashed_password, hash_salty(password)), True
+
+        _, n, r, p, salt, digest = hashed_password.split('$')
+        n, r, p = int(n), int(r), int(p)
+
+        is_valid = hmac.compare_digest(await self._scrypt(password, bytes.fromhex(salt), n, r, p), bytes.fromhex(digest))
+
+        return is_valid, (n, r, p) != (self._n, self._r, self._p)
+
+    def _scrypt(self, password: str, salt: bytes, n: int, r: int, p: int) -> asyncio.Future[bytes]:
+        # awaited on the event loop, so that no request handler thread is held while queued for (or running) the hash
+        return asyncio.wrap_future(self._pool.submit(_scrypt, password, salt, n, r, p))
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                          maxmem=128 * r * (n + p + 2) + 1024 * 1024, dklen=SCRYPT_HASH_LEN)
+
+
+password_hasher = PasswordHasher(**cfg['security']['password_hashing'])
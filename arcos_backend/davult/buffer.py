@@ -0,0 +1,138 @@
+import json
+import threading
+from typing import Callable
+
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+from . import models
+from .cache import user_directory
+from .database import LocalSession
+from .._shared import configuration as cfg
+
+
+# keeps the properties of recently updated users in memory and writes them behind, so that a burst of updates costs a single commit
+class PropertiesBuffer:
+    _session_factory: sessionmaker
+    _interval: float
+    # user id -> (properties, version); newer than the database while dirty
+    _documents: dict[int, tuple[dict, int]]
+    _dirty: set[int]
+    # clean and untouched since the last flush, these are dropped on the next one
+    _idle: set[int]
+    _lock: threading.Lock
+    _flush_lock: threading.Lock
+    _stopped: threading.Event
+    _thread: threading.Thread | None
+
+    def __init__(self, session_factory: sessionmaker, interval: float):
+        self._session_factory = session_factory
+        self._interval = interval
+        self._documents = {}
+        self._dirty = set()
+        self._idle = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def is_write_through(self) -> bool:
+        return self._interval <= 0
+
+    def get(self, user: models.User) -> tuple[dict, int]:
+        # the returned properties are shared, they must not be modified
+        with self._lock:
+            return self._get(user)
+
+    def update(self, user: models.User, properties: dict) -> tuple[dict, int]:
+        # only replaces the top level keys
+        return self.modify(user, lambda current: {**current, **properties})
+
+    def modify(self, user: models.User, function: Callable[[dict], dict], expected_version: int | None = None) -> tuple[dict, int]:
+        with self._lock:
+            current, version = self._get(user)
+
+            if expected_version is not None and expected_version != version:
+                raise RuntimeError(f"properties have changed (version {version})")
+
+            self._documents[user.id] = document = (function(current), version + 1)
+            self._dirty.add(user.id)
+            self._idle.discard(user.id)
+
+            return document
+
+    def discard(self, user_id: int):
+        with self._lock:
+            self._documents.pop(user_id, None)
+            self._dirty.discard(user_id)
+
+    def flush(self, user_id: int | None = None):
+        with self._flush_lock:
+            with self._lock:
+                flushed = {id: self._documents[id] for id in (self._dirty if user_id is None else self._dirty & {user_id})}
+                self._dirty -= flushed.keys()
+
+            try:
+                if flushed:
+                    self._write(flushed)
+            except BaseException:
+                with self._lock:
+                    self._dirty |= flushed.keys() & self._documents.keys()
+                raise
+
+            if user_id is None:
+                with self._lock:
+                    for idle_user_id in self._idle - self._dirty:
+                        self._documents.pop(idle_user_id, None)
+                    self._idle = self._documents.keys() - self._dirty
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="properties-buffer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        self.flush()
+
+    def _get(self, user: models.User) -> tuple[dict, int]:
+        # the database wins once it's caught up, or if it has been changed elsewhere since
+        if (document := self._documents.get(user.id)) is not None and document[1] > user.properties_version:
+            return document
+
+        return json.loads(user.properties), user.properties_version
+
+    def _write(self, documents: dict[int, tuple[dict, int]]):
+        is_directory_changed = False
+
+        with self._session_factory() as db:
+            # deleted users have their properties wiped, those are dropped
+            for user in db.scalars(select(models.User).where(models.User.id.in_(documents), models.User.is_deleted.is_not(True))):
+                properties, version = documents[user.id]
+
+                if version <= user.properties_version:
+                    continue
+
+                # the directory lists the `acc` section
+                is_directory_changed |= json.loads(user.properties).get('acc') != properties.get('acc')
+
+                models.set_properties(user, properties)
+                user.properties_version = version
+
+            db.commit()
+
+        if is_directory_changed:
+            user_directory.invalidate()
+
+    def _run(self):
+        # even when writing through, the idle documents have to be dropped
+        while not self._stopped.wait(self._interval if not self.is_write_through() else 1.0):
+            self.flush()
+
+
+properties_buffer = PropertiesBuffer(LocalSession, cfg['user_properties']['flush_interval'])
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy.orm import Session
+
+from . import models
+from .._metrics import metrics, CallbackMetric
+from .._shared import configuration as cfg
+
+
+class TokenCache:
+    _size: int
+    _ttl: float
+    _entries: OrderedDict[str, tuple[int, float]]
+    _lock: threading.Lock
+
+    hits: int
+    misses: int
+
+    def __init__(self, size: int, ttl: float):
+        self._size = size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, value: str) -> int | None:
+        with self._lock:
+            entry = self._entries.get(value)
+
+            if entry is None or entry[1] < time.time():
+                if entry is not None:
+                    del self._entries[value]
+
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(value)
+            self.hits += 1
+
+            return entry[0]
+
+    def put(self, value: str, owner_id: int, expires_at: float):
+        if self._size <= 0:
+            return
+
+        with self._lock:
+            # never outlive the token itself
+            self._entries[value] = (owner_id, min(time.time() + self._ttl, expires_at))
+            self._entries.move_to_end(value)
+
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, value: str):
+        with self._lock:
+            self._entries.pop(value, None)
+
+    def invalidate_owner(self, owner_id: int):
+        with self._lock:
+            for value in [value for value, entry in self._entries.items() if entry[0] == owner_id]:
+                del self._entries[value]
+
+    def get_hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get_stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+class UserDirectory:
+    _entries: list[dict] | None
+    _etag: str | None
+    _lock: threading.Lock
+
+    def __init__(self):
+        self._entries = None
+        self._etag = None
+        self._lock = threading.Lock()
+
+    def get(self, db: Session) -> tuple[list[dict], str]:
+        with self._lock:
+            # rebuilt lazily on the first read after a change
+            if self._entries is None:
+                entries = []
+
+                for username, properties in (db.query(models.User.username, models.User.properties)
+                                             .filter(models.User.is_enabled.is_(True), models.User.is_deleted.is_not(True))):
+                    entries.append({'username': username, 'acc': json.loads(properties)['acc']})
+
+                entries.sort(key=lambda item: item['username'])
+
+                self._entries = entries
+                self._etag = f'"{hashlib.sha1(json.dumps(entries).encode()).hexdigest()}"'
+
+            return self._entries, self._etag
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = None
+            self._etag = None
+
+
+token_cache = TokenCache(cfg['security']['token_cache']['size'], cfg['security']['token_cache']['ttl'])
+user_directory = UserDirectory()
+
+metrics.register(CallbackMetric("arcapi_token_cache_hits_total", "Tokens authenticated from the cache", lambda: token_cache.hits, 'counter'))
+metrics.register(CallbackMetric("arcapi_token_cache_misses_total", "Tokens looked up in the database", lambda: token_cache.misses, 'counter'))
+metrics.register(CallbackMetric("arcapi_token_cache_hit_ratio", "Share of tokens authenticated from the cache", token_cache.get_hit_ratio))
@@ -1,30 +1,49 @@
 import random
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from sqlalchemy.orm import Session
+from sqlalchemy import Row, Select, and_, or_, func, literal, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, aliased, joinedload
 
 from .. import models, schemas
 
 
 MAX_MESSAGE_LENGTH = 2000
+MAX_THREAD_DEPTH = 100
+MAX_THREAD_SIZE = 500
+CURSOR_EPOCH = datetime(1970, 1, 1)
 
 
 def send_message(db: Session, message: schemas.MessageCreate) -> models.Message:
+    db_message = _create_message(message)
+
+    db.add(db_message)
+    db.commit()
+    db.refresh(db_message)
+
+    return db_message
+
+
+async def send_message_async(db: AsyncSession, message: schemas.MessageCreate) -> models.Message:
+    db_message = _create_message(message)
+
+    db.add(db_message)
+    await db.commit()
+    await db.refresh(db_message)
+
+    return db_message
+
+
+def _create_message(message: schemas.MessageCreate) -> models.Message:
     if len(message.body) > MAX_MESSAGE_LENGTH:
         raise ValueError(f"too long message (>{MAX_MESSAGE_LENGTH})")
 
-    db_message = models.Message(
+    return models.Message(
         **message.dict(),
         id=random.randint(0, 999_999_999),
         sent_time=datetime.utcnow()
     )
 
-    db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
-
-    return db_message
-
 
 def delete_message(db: Session, message: models.Message):
     message.body = "[ deleted ]"
@@ -41,6 +60,20 @@ def get_message(db: Session, message_id: int) -> models.Message:
     return message
 
 
+async def get_message_async(db: AsyncSession, message_id: int) -> models.Message:
+    # relationships can't be lazy loaded in async sessions
+    message = await db.get(models.Message, message_id, options=[joinedload(models.Message.sender), joinedload(models.Message.receiver)])
+
+    if message is None:
+        raise LookupError(f"unknown message (ID: {message_id})")
+
+    return message
+
+
+def is_participant(message: models.Message, user_id: int) -> bool:
+    return user_id in (message.sender_id, message.receiver_id)
+
+
 def get_message_timestamp(message: models.Message) -> float:
     return message.sent_time.timestamp()
 
@@ -53,5 +86,138 @@ def mark_read(db: Session, message: models.Message):
     db.commit()
 
 
+async def mark_read_async(db: AsyncSession, message: models.Message):
+    if message.is_read:
+        return
+
+    message.is_read = True
+    await db.commit()
+
+
 def get_replies(db: Session, message: models.Message) -> list[models.Message]:
     return db.query(models.Message).filter(models.Message.replying_id == message.id).all()
+
+
+async def get_reply_ids_async(db: AsyncSession, message: models.Message) -> list[int]:
+    return (await db.scalars(_select_reply_ids(message.id))).all()
+
+
+def _select_reply_ids(message_id: int) -> Select:
+    return select(models.Message.id).where(models.Message.replying_id == message_id)
+
+
+def list_messages(db: Session, user_id: int, preview_length: int, count: int = -1, offset: int = 0, descending: bool = True,
+                  before: tuple[datetime, int] | None = None, after: tuple[datetime, int] | None = None) -> list[Row]:
+    return db.execute(_select_messages(user_id, preview_length, count, offset, descending, before, after)).all()
+
+
+async def list_messages_async(db: AsyncSession, user_id: int, preview_length: int, count: int = -1, offset: int = 0, descending: bool = True,
+                              before: tuple[datetime, int] | None = None, after: tuple[datetime, int] | None = None) -> list[Row]:
+    return (await db.execute(_select_messages(user_id, preview_length, count, offset, descending, before, after))).all()
+
+
+def _select_messages(user_id: int, preview_length: int, count: int, offset: int, descending: bool,
+                     before: tuple[datetime, int] | None, after: tuple[datetime, int] | None) -> Select:
+    sender, receiver = aliased(models.User), aliased(models.User)
+
+    query = (select(models.Message.id,
+                    models.Message.replying_id,
+                    models.Message.sent_time,
+                    models.Message.is_read,
+                    func.substr(models.Message.body, 1, preview_length).label('partial_body'),
+                    sender.username.label('sender'),
+                    receiver.username.label('receiver'))
+             .join(sender, models.Message.sender_id == sender.id)
+             .join(receiver, models.Message.receiver_id == receiver.id)
+             .where(or_(models.Message.sender_id == user_id, models.Message.receiver_id == user_id),
+                    models.Message.is_deleted.is_not(True)))
+
+    # keyset pagination, ties on the timestamp are broken by the id
+    if before is not None:
+        query = query.where(or_(models.Message.sent_time < before[0],
+                                and_(models.Message.sent_time == before[0], models.Message.id < before[1])))
+    if after is not None:
+        query = query.where(or_(models.Message.sent_time > after[0],
+                                and_(models.Message.sent_time == after[0], models.Message.id > after[1])))
+
+    if descending:
+        query = query.order_by(models.Message.sent_time.desc(), models.Message.id.desc())
+    else:
+        query = query.order_by(models.Message.sent_time, models.Message.id)
+
+    if count != -1:
+        query = query.limit(count)
+
+    return query.offset(offset)
+
+
+def encode_cursor(sent_time: datetime, message_id: int) -> str:
+    return f"{(sent_time - CURSOR_EPOCH) // timedelta(microseconds=1)}:{message_id}"
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    sent_time, _, message_id = cursor.partition(':')
+
+    # ids are bound as 64-bit integers
+    if not 0 <= (message_id := int(message_id)) < 2 ** 63:
+        raise ValueError(f"message ID out of range ({message_id})")
+
+    # overflows with a time too far out
+    return CURSOR_EPOCH + timedelta(microseconds=int(sent_time)), message_id
+
+
+async def get_thread_root_id_async(db: AsyncSession, message_id: int, max_depth: int = MAX_THREAD_DEPTH) -> int:
+    root_id = (await db.execute(_select_thread_root_id(message_id, max_depth))).scalar()
+
+    if root_id is None:
+        raise LookupError(f"unknown message (ID: {message_id})")
+
+    return root_id
+
+
+def _select_thread_root_id(message_id: int, max_depth: int) -> Select:
+    parent = aliased(models.Message)
+
+    ancestors = (select(models.Message.id, models.Message.replying_id, literal(0).label('depth'))
+                 .where(models.Message.id == message_id)
+                 .cte('ancestors', recursive=True))
+    ancestors = ancestors.union_all(
+        select(parent.id, parent.replying_id, ancestors.c.depth + 1)
+        .join(ancestors, parent.id == ancestors.c.replying_id)
+        .where(ancestors.c.depth < max_depth)
+    )
+
+    return select(ancestors.c.id).order_by(ancestors.c.depth.desc()).limit(1)
+
+
+async def get_thread_async(db: AsyncSession, root_id: int, user_id: int, preview_length: int,
+                           max_depth: int = MAX_THREAD_DEPTH, max_size: int = MAX_THREAD_SIZE) -> list[Row]:
+    return (await db.execute(_select_thread(root_id, user_id, preview_length, max_depth, max_size))).all()
+
+
+def _select_thread(root_id: int, user_id: int, preview_length: int, max_depth: int, max_size: int) -> Select:
+    reply = aliased(models.Message)
+    sender, receiver = aliased(models.User), aliased(models.User)
+
+    # the root is always included, its descendants only as long as the user takes part in them
+    thread = (select(models.Message.id, literal(0).label('depth'))
+              .where(models.Message.id == root_id)
+              .cte('thread', recursive=True))
+    thread = thread.union_all(
+        select(reply.id, thread.c.depth + 1)
+        .join(thread, reply.replying_id == thread.c.id)
+        .where(thread.c.depth < max_depth, or_(reply.sender_id == user_id, reply.receiver_id == user_id))
+    )
+
+    # ordered by depth, so that every parent comes before its replies (and survives the size limit)
+    return (select(models.Message.id,
+                   models.Message.replying_id,
+                   models.Message.sent_time,
+                   func.substr(models.Message.body, 1, preview_length).label('partial_body'),
+                   sender.username.label('sender'),
+                   receiver.username.label('receiver'))
+            .join(thread, models.Message.id == thread.c.id)
+            .join(sender, models.Message.sender_id == sender.id)
+            .join(receiver, models.Message.receiver_id == receiver.id)
+            .order_by(thread.c.depth, models.Message.sent_time, models.Message.id)
+            .limit(max_size))
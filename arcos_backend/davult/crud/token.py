@@ -1,29 +1,41 @@
-import time
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from . import user as user_db
 from .. import models, schemas
+from ..cache import token_cache
 
 
-def generate_token(db: Session, token: schemas.TokenCreate) -> models.Token:
-    owner = user_db.get_user(db, token.owner_id)
+async def generate_token_async(db: AsyncSession, token: schemas.TokenCreate, max_sessions: int | None = None) -> models.Token:
+    owner = await user_db.get_user_async(db, token.owner_id)
 
-    if not user_db.validate_credentials(owner, token.password):
+    if not await user_db.validate_credentials_async(db, owner, token.password):
         raise ValueError("invalid credentials")
 
+    creation_time = datetime.utcnow()
     db_token = models.Token(
         value=str(uuid.uuid4()),
         owner_id=owner.id,
         lifetime=token.lifetime,
-        creation_time=datetime.utcnow()
+        creation_time=creation_time,
+        expires_at=creation_time + timedelta(seconds=token.lifetime)
     )
 
     db.add(db_token)
-    db.commit()
-    db.refresh(db_token)
+    await db.commit()
+    await db.refresh(db_token)
+
+    if max_sessions is not None:
+        # evict the oldest sessions over the limit
+        for stale_token in (await db.scalars(select(models.Token)
+                                             .where(models.Token.owner_id == owner.id)
+                                             .order_by(models.Token.creation_time.desc())
+                                             .offset(max_sessions))).all():
+            await expire_token_async(db, stale_token)
 
     return db_token
 
@@ -37,14 +49,45 @@ def find_token(db: Session, value: str) -> models.Token:
     return token
 
 
+async def find_token_async(db: AsyncSession, value: str) -> models.Token:
+    token = await db.get(models.Token, value)
+
+    if token is None:
+        raise LookupError(f"unknown token (value: {value})")
+
+    return token
+
+
 def expire_token(db: Session, token: models.Token):
+    token_cache.invalidate(token.value)
     db.delete(token)
     db.commit()
 
 
-def validate_token(db: Session, token: models.Token) -> models.User:
-    if token.creation_time.timestamp() + token.lifetime < time.time():
-        expire_token(db, token)
+async def expire_token_async(db: AsyncSession, token: models.Token):
+    token_cache.invalidate(token.value)
+    await db.delete(token)
+    await db.commit()
+
+
+def delete_expired_tokens(db: Session, limit: int) -> int:
+    expired = select(models.Token.value).where(models.Token.expires_at < datetime.utcnow()).limit(limit)
+
+    count = db.execute(delete(models.Token).where(models.Token.value.in_(expired))).rowcount
+    db.commit()
+
+    return count
+
+
+def get_token_expiry(token: models.Token) -> float:
+    return token.expires_at.replace(tzinfo=timezone.utc).timestamp()
+
+
+def validate_token(db: Session, token: models.Token, expire: bool = True) -> models.User:
+    if token.expires_at < datetime.utcnow():
+        # read only sessions leave it to the session reaper
+        if expire:
+            expire_token(db, token)
         raise ValueError("token has expired")
 
     user = db.get(models.User, token.owner_id)
@@ -53,3 +96,55 @@ def validate_token(db: Session, token: models.Token) -> models.User:
         raise LookupError("token is owned by an invalid user")
 
     return user
+
+
+async def validate_token_async(db: AsyncSession, token: models.Token, expire: bool = True) -> models.User:
+    if token.expires_at < datetime.utcnow():
+        if expire:
+            await expire_token_async(db, token)
+        raise ValueError("token has expired")
+
+    user = await db.get(models.User, token.owner_id)
+
+    if user is None:
+        raise LookupError("token is owned by an invalid user")
+
+    return user
+
+
+def authenticate(db: Session, value: str, expire: bool = True) -> models.User:
+    owner_id = token_cache.get(value)
+
+    if owner_id is None:
+        token = find_token(db, value)
+        user = validate_token(db, token, expire)
+        token_cache.put(value, user.id, get_token_expiry(token))
+
+        return user
+
+    user = db.get(models.User, owner_id)
+
+    if user is None:
+        token_cache.invalidate(value)
+        raise LookupError("token is owned by an invalid user")
+
+    return user
+
+
+async def authenticate_async(db: AsyncSession, value: str, expire: bool = True) -> models.User:
+    owner_id = token_cache.get(value)
+
+    if owner_id is None:
+        token = await find_token_async(db, value)
+        user = await validate_token_async(db, token, expire)
+        token_cache.put(value, user.id, get_token_expiry(token))
+
+        return user
+
+    user = await db.get(models.User, owner_id)
+
+    if user is None:
+        token_cache.invalidate(value)
+        raise LookupError("token is owned by an invalid user")
+
+    return user
@@ -1,28 +1,33 @@
+import asyncio
 import json
 import random
 from datetime import datetime
 
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from . import message as msg_db, token as token_db
 from .. import models, schemas
-from ..._utils import hash_salty, validate_username, check_profanity, MAX_USERNAME_LEN
+from ..buffer import properties_buffer
+from ..cache import token_cache, user_directory
+from ..._utils import password_hasher, validate_username, check_profanity, MAX_USERNAME_LEN
 
 
-def create_user(db: Session, user: schemas.UserCreate) -> models.User:
+async def create_user_async(db: AsyncSession, user: schemas.UserCreate) -> models.User:
     if not validate_username(user.username):
         raise ValueError(f"username is too long (>{MAX_USERNAME_LEN})")
 
     if check_profanity(user.username):
         raise ValueError(f"username contains offensive strings")
 
-    hashed_password = hash_salty(user.password)
+    hashed_password = await password_hasher.hash(user.password)
 
     user = user.dict()
 
     del user['password']
-    user['properties'] = json.dumps(user['properties'])
+    properties = user.pop('properties')
 
     db_user = models.User(
         **user,
@@ -30,30 +35,40 @@ def create_user(db: Session, user: schemas.UserCreate) -> models.User:
         hashed_password=hashed_password,
         creation_time=datetime.utcnow()
     )
+    models.set_properties(db_user, properties)
 
     db.add(db_user)
     try:
-        db.commit()
+        await db.commit()
     except IntegrityError:
         raise RuntimeError("such username already exists")
-    db.refresh(db_user)
+    await db.refresh(db_user)
+
+    user_directory.invalidate()
 
     return db_user
 
 
 def delete_user(db: Session, user: models.User):
+    properties_buffer.discard(user.id)
+
     user.username = f'deleted#{user.id}'
-    user.properties = "{}"
+    models.set_properties(user, {})
+    user.properties_version += 1
     user.hashed_password = None
     user.is_deleted = True
     db.commit()
 
+    user_directory.invalidate()
+
     for message in user.sent_messages:
         msg_db.delete_message(db, message)
 
     for token in user.tokens:
         token_db.expire_token(db, token)
 
+    token_cache.invalidate_owner(user.id)
+
 
 def get_user(db: Session, user_id: int) -> models.User:
     db_user = db.get(models.User, user_id)
@@ -64,6 +79,15 @@ def get_user(db: Session, user_id: int) -> models.User:
     return db_user
 
 
+async def get_user_async(db: AsyncSession, user_id: int) -> models.User:
+    db_user = await db.get(models.User, user_id)
+
+    if db_user is None:
+        raise LookupError(f"unknown user (ID: {user_id})")
+
+    return db_user
+
+
 def find_user(db: Session, username: str) -> models.User:
     db_user = db.query(models.User).filter(
         models.User.username == username).first()
@@ -74,41 +98,86 @@ def find_user(db: Session, username: str) -> models.User:
     return db_user
 
 
+async def find_user_async(db: AsyncSession, username: str) -> models.User:
+    db_user = await db.scalar(select(models.User).where(models.User.username == username).limit(1))
+
+    if db_user is None:
+        raise LookupError(f"unknown user (username: {username})")
+
+    return db_user
+
+
 def rename_user(db: Session, user: models.User, new_username: str):
     if not validate_username(new_username):
         raise ValueError(f"new username is too long (>{MAX_USERNAME_LEN})")
 
+    if check_profanity(new_username):
+        raise ValueError(f"new username contains offensive strings")
+
     user.username = new_username
     db.commit()
 
+    user_directory.invalidate()
 
-def set_user_password(db: Session, user: models.User, new_password: str):
-    user.hashed_password = hash_salty(new_password)
-    db.commit()
 
+async def set_user_password_async(db: AsyncSession, user: models.User, new_password: str):
+    user.hashed_password = await password_hasher.hash(new_password)
+    await db.commit()
 
-def set_user_state(db: Session, user: models.User, state: bool):
-    properties = json.loads(user.properties)
-    properties['acc']['enabled'] = state
-    user.properties = json.dumps(properties)
-    db.commit()
+    token_cache.invalidate_owner(user.id)
+
+
+async def set_user_state_async(db: AsyncSession, user: models.User, state: bool):
+    # goes through the buffer, so that it's ordered with the buffered updates
+    properties_buffer.modify(user, lambda properties: {**properties, 'acc': {**properties['acc'], 'enabled': state}})
+    await asyncio.to_thread(properties_buffer.flush, user.id)
+    await db.refresh(user)
 
     # if banning -> invalidate all tokens
     if not state:
-        for token in user.tokens:
-            token_db.expire_token(db, token)
+        for token in await db.scalars(select(models.Token).where(models.Token.owner_id == user.id)):
+            await token_db.expire_token_async(db, token)
+
+        token_cache.invalidate_owner(user.id)
 
 
 def update_user_properties(db: Session, user: models.User, properties: dict):
+    _merge_user_properties(user, properties)
+    db.commit()
+
+    # the directory lists the `acc` section
+    if 'acc' in properties:
+        user_directory.invalidate()
+
+
+async def update_user_properties_async(db: AsyncSession, user: models.User, properties: dict):
+    _merge_user_properties(user, properties)
+    await db.commit()
+
+    if 'acc' in properties:
+        user_directory.invalidate()
+
+
+def _merge_user_properties(user: models.User, properties: dict):
     updated_properties = json.loads(user.properties)
     updated_properties.update(properties)
-    user.properties = json.dumps(updated_properties)
-    db.commit()
+    models.set_properties(user, updated_properties)
+    user.properties_version += 1
 
 
 def get_users(db: Session) -> list[models.User]:
     return db.query(models.User).all()
 
 
-def validate_credentials(user: models.User, password: str) -> bool:
-    return user.hashed_password == hash_salty(password)
+async def validate_credentials_async(db: AsyncSession, user: models.User, password: str) -> bool:
+    if user.hashed_password is None:  # deleted user
+        return False
+
+    is_valid, needs_rehash = await password_hasher.verify(user.hashed_password, password)
+
+    # transparently moves legacy hashes (and outdated cost parameters) to the current ones
+    if is_valid and needs_rehash:
+        user.hashed_password = await password_hasher.hash(password)
+        await db.commit()
+
+    return is_valid
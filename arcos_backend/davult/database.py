@@ -1,14 +1,95 @@
 import os
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from .._shared import configuration as cfg
 
 
-SQLALCHEMY_DATABASE_URL = f"sqlite:///./{os.path.join(cfg['storage']['root'], cfg['storage']['database'])}"
+SQLALCHEMY_DATABASE_URL = cfg['database']['url'] or f"sqlite:///./{os.path.join(cfg['storage']['root'], cfg['storage']['database'])}"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+
+def create_database_engine(url: str, pool_size: int, max_overflow: int, pool_timeout: float = 30, read_only: bool = False) -> Engine:
+    new_engine = create_engine(url, **_get_engine_options(url, pool_size, max_overflow, pool_timeout))
+    _apply_pragmas(new_engine, read_only)
+
+    return new_engine
+
+
+def create_async_database_engine(url: str, pool_size: int, max_overflow: int, pool_timeout: float = 30, read_only: bool = False) -> AsyncEngine:
+    options = _get_engine_options(url, pool_size, max_overflow, pool_timeout)
+    # aiosqlite would open a new connection (and a thread) for every session otherwise
+    if 'pool_size' in options:
+        options['poolclass'] = AsyncAdaptedQueuePool
+
+    new_engine = create_async_engine(url, **options)
+    _apply_pragmas(new_engine.sync_engine, read_only)
+
+    return new_engine
+
+
+def get_async_url(url: str) -> str:
+    if url.startswith('sqlite://'):
+        return url.replace('sqlite://', 'sqlite+aiosqlite://', 1)
+
+    raise ValueError(f"no async driver is known for {url!r}, set `async_url`")
+
+
+def _get_engine_options(url: str, pool_size: int, max_overflow: int, pool_timeout: float) -> dict:
+    pool_options = {'pool_size': pool_size, 'max_overflow': max_overflow, 'pool_timeout': pool_timeout}
+
+    if not url.startswith('sqlite'):
+        return pool_options
+
+    options = {'connect_args': {"check_same_thread": False}}
+    # the in-memory database only exists within its single connection
+    if ':memory:' not in url and url.partition('://')[2] not in ('', '/'):
+        options.update(pool_options)
+
+    return options
+
+
+def _apply_pragmas(new_engine: Engine, read_only: bool):
+    if new_engine.url.get_backend_name() != 'sqlite':
+        return
+
+    pragmas = dict(cfg['database']['pragmas'])
+    if read_only:
+        pragmas['query_only'] = 'on'
+
+    @event.listens_for(new_engine, 'connect')
+    def apply_pragmas(connection, _):
+        cursor = connection.cursor()
+        for name, value in pragmas.items():
+            if value is not None:
+                cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+engine = create_database_engine(SQLALCHEMY_DATABASE_URL, cfg['database']['pool_size'], cfg['database']['max_overflow'], cfg['database']['pool_timeout'])
 LocalSession = sessionmaker(bind=engine)
 
+# the async endpoints use their own pool, objects are kept loaded after commits as they can't be lazily refreshed
+async_engine = create_async_database_engine(cfg['database']['async_url'] or get_async_url(SQLALCHEMY_DATABASE_URL),
+                                            cfg['database']['pool_size'], cfg['database']['max_overflow'], cfg['database']['pool_timeout'])
+AsyncLocalSession = async_sessionmaker(bind=async_engine, expire_on_commit=False)
+
+# readers get their own connections, so that they never queue behind the writers for one
+if (read_pool := cfg['database']['read_pool']) is not None:
+    read_url = read_pool['url'] or SQLALCHEMY_DATABASE_URL
+
+    read_engine = create_database_engine(read_url, read_pool['pool_size'], read_pool['max_overflow'], read_pool['pool_timeout'], read_only=True)
+    ReadSession = sessionmaker(bind=read_engine)
+
+    async_read_engine = create_async_database_engine(read_pool['async_url'] or get_async_url(read_url),
+                                                     read_pool['pool_size'], read_pool['max_overflow'], read_pool['pool_timeout'], read_only=True)
+    AsyncReadSession = async_sessionmaker(bind=async_read_engine, expire_on_commit=False)
+else:
+    read_engine = async_read_engine = None
+    ReadSession = LocalSession
+    AsyncReadSession = AsyncLocalSession
+
 Base = declarative_base()
@@ -0,0 +1,54 @@
+import json
+from datetime import timedelta
+from typing import Callable
+
+from sqlalchemy import Column, Connection, Engine, inspect, select, update
+
+from . import models
+
+
+def migrate(engine: Engine):
+    # `create_all` only creates missing tables, so columns and indexes added later are brought in here
+    with engine.begin() as connection:
+        _add_column(connection, models.Token.expires_at, _backfill_token_expiry)
+        _add_column(connection, models.User.properties_version, _backfill_properties_version)
+        _add_column(connection, models.User.is_enabled, _backfill_enabled)
+
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+def _add_column(connection: Connection, column: Column, backfill: Callable[[Connection], None]):
+    table = column.table
+
+    if column.name in {existing['name'] for existing in inspect(connection).get_columns(table.name)}:
+        return
+
+    column_type = column.type.compile(dialect=connection.dialect)
+    connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+
+    backfill(connection)
+
+
+def _backfill_token_expiry(connection: Connection):
+    token = models.Token.__table__
+
+    for value, creation_time, lifetime in connection.execute(select(token.c.value, token.c.creation_time, token.c.lifetime)).all():
+        connection.execute(update(token)
+                           .where(token.c.value == value)
+                           .values(expires_at=creation_time + timedelta(seconds=lifetime)))
+
+
+def _backfill_properties_version(connection: Connection):
+    user = models.User.__table__
+    connection.execute(update(user).values(properties_version=0))
+
+
+def _backfill_enabled(connection: Connection):
+    user = models.User.__table__
+
+    for id, properties in connection.execute(select(user.c.id, user.c.properties)).all():
+        connection.execute(update(user)
+                           .where(user.c.id == id)
+                           .values(is_enabled=models.get_enabled(json.loads(properties or '{}'))))
@@ -1,7 +1,7 @@
 import json
 import os
 
-from sqlalchemy import Column, Integer, String, Boolean, Float, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, Float, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relationship
 
 from .database import Base
@@ -16,9 +16,10 @@ class Token(Base):
     __tablename__ = "tokens"
 
     value = Column(String, primary_key=True, index=True)
-    owner_id = Column(ForeignKey("users.id"))
+    owner_id = Column(ForeignKey("users.id"), index=True)
     lifetime = Column(Float)
     creation_time = Column(DateTime)
+    expires_at = Column(DateTime, index=True)
 
     owner = relationship("User", back_populates="tokens")
 
@@ -30,7 +31,7 @@ class Message(Base):
     sender_id = Column(ForeignKey("users.id"))
     receiver_id = Column(ForeignKey("users.id"))
     body = Column(String)
-    replying_id = Column(ForeignKey("messages.id"), default=None)
+    replying_id = Column(ForeignKey("messages.id"), default=None, index=True)
     sent_time = Column(DateTime)
     is_read = Column(Boolean, default=False)
     is_deleted = Column(Boolean, default=False)
@@ -39,6 +40,11 @@ class Message(Base):
     receiver = relationship("User", back_populates="received_messages", foreign_keys=receiver_id)
     # replies = relationship("Message", back_populates="replies", remote_side=[id])  # TODO make da thing to work
 
+    __table_args__ = (
+        Index('ix_messages_receiver_id_sent_time', receiver_id, sent_time),
+        Index('ix_messages_sender_id_sent_time', sender_id, sent_time),
+    )
+
 
 class User(Base):
     global USER_DEFAULT_PROPERTIES
@@ -50,6 +56,8 @@ class User(Base):
     hashed_password = Column(String)
     creation_time = Column(DateTime)
     properties = Column(String, default=USER_DEFAULT_PROPERTIES_STR)
+    properties_version = Column(Integer, default=0)  # bumped on every change of `properties`
+    is_enabled = Column(Boolean, default=True, index=True)  # mirrors `acc.enabled` of `properties`, see `set_properties`
     is_deleted = Column(Boolean, default=False)
 
     tokens = relationship("Token", back_populates="owner")
@@ -57,5 +65,10 @@ class User(Base):
     received_messages = relationship("Message", back_populates="receiver", foreign_keys=Message.receiver_id)
 
 
-def is_enabled(user: User) -> bool:
-    return json.loads(user.properties)['acc']['enabled']
+def set_properties(user: User, properties: dict):
+    user.properties = json.dumps(properties)
+    user.is_enabled = get_enabled(properties)
+
+
+def get_enabled(properties: dict) -> bool:
+    return isinstance(acc := properties.get('acc'), dict) and bool(acc.get('enabled'))
@@ -0,0 +1,49 @@
+import threading
+
+from sqlalchemy.orm import sessionmaker
+
+from .crud import token as token_db
+
+
+class SessionReaper:
+    _session_factory: sessionmaker
+    _interval: float
+    _batch_size: int
+    _stopped: threading.Event
+    _thread: threading.Thread | None
+
+    def __init__(self, session_factory: sessionmaker, interval: float, batch_size: int):
+        self._session_factory = session_factory
+        self._interval = interval
+        self._batch_size = batch_size
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="session-reaper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def reap(self) -> int:
+        reaped = 0
+
+        with self._session_factory() as db:
+            # every batch is its own transaction, so that the write lock is never held for long
+            while not self._stopped.is_set() and (count := token_db.delete_expired_tokens(db, self._batch_size)):
+                reaped += count
+
+        return reaped
+
+    def _run(self):
+        while True:
+            self.reap()
+
+            if self._stopped.wait(self._interval):
+                break
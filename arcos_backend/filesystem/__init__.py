@@ -1,18 +1,45 @@
+import errno
 import mimetypes
 from os import PathLike
 from pathlib import Path
+from typing import BinaryIO, Callable, NamedTuple
 import shutil
+import stat
+import uuid
 import os
 
 from . import mime
+from .confine import DIRECTORY_FLAGS, open_directory, parent_directory, split_path
+from .ledger import UsageLedger
+from .overlay import Overlay
+from .template import TemplateCache
 
 DEFAULT_MIMETYPE = 'text/plain'  # maybe should be application/octet-stream?
+LEDGER_DIRECTORY = '.usage'
+TEMPLATE_CACHE_DIRECTORY = '.template'
+OVERLAY_DIRECTORY = '.overlay'
 
+FILE_FLAGS = os.O_NOFOLLOW | os.O_CLOEXEC
+COPY_BUFFER_SIZE = 1024 * 1024
 
+
+class DirectoryEntry(NamedTuple):
+    name: str
+    is_directory: bool
+    size: int
+    mime: str | None
+    created: float
+    modified: float
+
+
+# paths are relative to `dir_fd` (the root by default) and every operation is confined beneath it, see `confine`
 class Filesystem:
     _root: Path
+    _root_fd: int
     _template: Path | None
     _userspace_size: int
+    _ledger: UsageLedger
+    _template_cache: TemplateCache | None
 
     def __init__(self, root_path: PathLike | str, template_path: PathLike | str | None, userspace_size: int):
         self._root = Path(root_path)
@@ -20,9 +47,14 @@ class Filesystem:
         self._userspace_size = userspace_size
 
         self._root.mkdir(parents=True, exist_ok=True)
+        # the root itself may be a symlink
+        self._root_fd = os.open(self._root, DIRECTORY_FLAGS & ~os.O_NOFOLLOW)
+        self._ledger = UsageLedger(self._root.joinpath(LEDGER_DIRECTORY))
+        self._template_cache = None
 
         if self._template is not None:
             self._template.mkdir(parents=True, exist_ok=True)
+            self._template_cache = TemplateCache(self._template, self._root.joinpath(TEMPLATE_CACHE_DIRECTORY))
 
     def get_userspace_size(self):
         return self._userspace_size
@@ -33,70 +65,329 @@ class Filesystem:
     def get_template_path(self):
         return self._template
 
-    def mkdir(self, path: PathLike | str):
-        self._root.joinpath(path).mkdir(exist_ok=True)
+    def open_directory(self, path: PathLike | str, dir_fd: int | None = None) -> int:
+        return open_directory(self._at(dir_fd), path)
+
+    def exists(self, path: PathLike | str, dir_fd: int | None = None) -> bool:
+        return self._get_mode(path, dir_fd) is not None
+
+    def is_dir(self, path: PathLike | str, dir_fd: int | None = None) -> bool:
+        return (mode := self._get_mode(path, dir_fd)) is not None and stat.S_ISDIR(mode)
 
-    def listdir(self, path: PathLike | str):
+    def is_file(self, path: PathLike | str, dir_fd: int | None = None) -> bool:
+        return (mode := self._get_mode(path, dir_fd)) is not None and stat.S_ISREG(mode)
+
+    def mkdir(self, path: PathLike | str, dir_fd: int | None = None):
+        with parent_directory(self._at(dir_fd), path) as (fd, name):
+            try:
+                os.mkdir(name, dir_fd=fd)
+            except FileExistsError:
+                if not stat.S_ISDIR(os.stat(name, dir_fd=fd, follow_symlinks=False).st_mode):
+                    raise
+
+    def listdir(self, path: PathLike | str, dir_fd: int | None = None):
         files, directories = [], []
 
-        path = self._root.joinpath(path)
-        for child in path.iterdir():
-            if child.is_file():
-                files.append(child)
-            elif child.is_dir():
-                directories.append(child)
+        for entry in self.scandir(path, dir_fd):
+            (directories if entry.is_directory else files).append(Path(path, entry.name))
 
         return files, directories
 
-    def write(self, path: PathLike | str, data: bytes):
-        self._root.joinpath(path).write_bytes(data)
+    def scandir(self, path: PathLike | str, dir_fd: int | None = None) -> list[DirectoryEntry]:
+        entries = []
+        fd = open_directory(self._at(dir_fd), path)
+
+        try:
+            with os.scandir(fd) as iterator:
+                for entry in iterator:
+                    # one `stat` per entry, which `DirEntry` caches for all the fields below
+                    try:
+                        entry_stat = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:  # removed while listing
+                        continue
+
+                    if stat.S_ISDIR(entry_stat.st_mode):
+                        entries.append(DirectoryEntry(entry.name, True, 0, None, entry_stat.st_ctime, entry_stat.st_mtime))
+                    elif stat.S_ISREG(entry_stat.st_mode):
+                        entries.append(DirectoryEntry(entry.name, False, entry_stat.st_size,
+                                                      mimetypes.guess_type(entry.name)[0] or DEFAULT_MIMETYPE,
+                                                      entry_stat.st_ctime, entry_stat.st_mtime))
+        finally:
+            os.close(fd)
+
+        return entries
+
+    def write(self, path: PathLike | str, data: bytes, dir_fd: int | None = None):
+        with parent_directory(self._at(dir_fd), path) as (fd, name):
+            _unshare(fd, name)
+
+            with open(os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | FILE_FLAGS, 0o666, dir_fd=fd), 'wb') as file:
+                file.write(data)
+
+    def open_temporary(self, path: PathLike | str, dir_fd: int | None = None) -> tuple[Path, BinaryIO]:
+        # kept next to the destination so that replacing it later is an atomic rename
+        path = Path(path)
+        temporary = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.part')
+
+        with parent_directory(self._at(dir_fd), temporary) as (fd, name):
+            return temporary, open(os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | FILE_FLAGS, 0o666, dir_fd=fd), 'wb')
+
+    def replace(self, source: PathLike | str, destination: PathLike | str, dir_fd: int | None = None):
+        with (parent_directory(self._at(dir_fd), source) as (source_fd, source_name),
+              parent_directory(self._at(dir_fd), destination) as (destination_fd, destination_name)):
+            os.replace(source_name, destination_name, src_dir_fd=source_fd, dst_dir_fd=destination_fd)
+
+    def remove(self, path: PathLike | str, dir_fd: int | None = None):
+        with parent_directory(self._at(dir_fd), path) as (fd, name):
+            if stat.S_ISDIR(os.stat(name, dir_fd=fd, follow_symlinks=False).st_mode):
+                shutil.rmtree(name, dir_fd=fd)
+            else:
+                os.unlink(name, dir_fd=fd)
+
+    def move(self, source: PathLike | str, destination: PathLike | str, dir_fd: int | None = None):
+        with parent_directory(self._at(dir_fd), source) as (source_fd, source_name):
+            # like `shutil.move`, into the destination if it's a directory
+            if self.is_dir(destination, dir_fd):
+                destination = Path(destination, source_name)
 
-    def remove(self, path: PathLike | str):
-        path = self._root.joinpath(path)
-        if path.is_dir():
-            shutil.rmtree(path)
-        else:
-            path.unlink()
+                if self.exists(destination, dir_fd):
+                    raise FileExistsError(f"{destination} already exists")
 
-    def move(self, source: PathLike | str, destination: PathLike | str):
-        shutil.move(self._root.joinpath(source),
-                    self._root.joinpath(destination))
+            with parent_directory(self._at(dir_fd), destination) as (destination_fd, destination_name):
+                os.rename(source_name, destination_name, src_dir_fd=source_fd, dst_dir_fd=destination_fd)
+
+    def copy(self, source: PathLike | str, destination: PathLike | str, dir_fd: int | None = None) -> int:
+        # returns the size of the copies charged for, see `_copy_file`
+        with parent_directory(self._at(dir_fd), source) as (source_fd, source_name):
+            if not stat.S_ISDIR(os.stat(source_name, dir_fd=source_fd, follow_symlinks=False).st_mode):
+                if self.is_dir(destination, dir_fd):
+                    destination = Path(destination, source_name)
+
+                with parent_directory(self._at(dir_fd), destination) as (destination_fd, destination_name):
+                    return _copy_file(source_fd, source_name, destination_fd, destination_name)
+
+            source_fd = open_directory(source_fd, source_name)
+            try:
+                with parent_directory(self._at(dir_fd), destination) as (destination_fd, destination_name):
+                    return _copy_tree(source_fd, destination_fd, destination_name)
+            finally:
+                os.close(source_fd)
+
+    def read(self, path: PathLike | str, dir_fd: int | None = None) -> bytes:
+        with parent_directory(self._at(dir_fd), path) as (fd, name):
+            with open(os.open(name, os.O_RDONLY | FILE_FLAGS, dir_fd=fd), 'rb') as file:
+                return file.read()
+
+    def open_read(self, path: PathLike | str, dir_fd: int | None = None) -> BinaryIO:
+        # for streaming, the file stays the one opened here even if its path gets swapped for a symlink meanwhile
+        with parent_directory(self._at(dir_fd), path) as (fd, name):
+            try:
+                file_fd = os.open(name, os.O_RDONLY | FILE_FLAGS, dir_fd=fd)
+            except OSError as e:
+                if e.errno == errno.ELOOP:
+                    raise ValueError("path breaks out of the filesystem")
+                raise
 
-    def copy(self, source: PathLike | str, destination: PathLike | str):
         try:
-          shutil.copytree(self._root.joinpath(source),
-                      self._root.joinpath(destination))
-        except NotADirectoryError:
-          shutil.copy(self._root.joinpath(source),
-                      self._root.joinpath(destination))
+            return open(file_fd, 'rb')
+        except OSError:  # a directory
+            os.close(file_fd)
+            raise
+
+    def get_size(self, path: PathLike | str, dir_fd: int | None = None) -> int:
+        # shared (template) files aren't charged to anyone
+        try:
+            if not split_path(path):  # the root itself
+                return _get_directory_size(self._at(dir_fd), '.')
+
+            with parent_directory(self._at(dir_fd), path) as (fd, name):
+                path_stat = os.stat(name, dir_fd=fd, follow_symlinks=False)
+
+                if not stat.S_ISDIR(path_stat.st_mode):
+                    return _get_charged_size(path_stat)
 
-    def read(self, path: PathLike | str) -> bytes:
-        return self._root.joinpath(path).read_bytes()
+                return _get_directory_size(fd, name)
+        except FileNotFoundError:
+            return 0
 
-    def get_size(self, path: PathLike | str) -> int:
-        path = self._root.joinpath(path)
+    def get_usage(self, path: PathLike | str) -> int:
+        return self._ledger.get(str(path), lambda: self.get_size(path))
 
-        if path.is_file():
-            return path.stat().st_size
+    def reserve_usage(self, path: PathLike | str, delta: int, is_saved: bool = True):
+        self._ledger.reserve(str(path), delta, self._userspace_size, lambda: self.get_size(path), is_saved)
 
-        directory_size = 0
+    def adjust_usage(self, path: PathLike | str, delta: int, is_saved: bool = True):
+        self._ledger.adjust(str(path), delta, lambda: self.get_size(path), is_saved)
 
-        for child in path.rglob("*"):
-            directory_size += child.stat().st_size
+    def reconcile_usage(self, path: PathLike | str) -> int:
+        self._ledger.reset(str(path), usage := self.get_size(path))
+        return usage
 
-        return directory_size
+    def drop_usage(self, path: PathLike | str):
+        self._ledger.drop(str(path))
 
     def get_mime(self, path: PathLike | str) -> str:
         return mimetypes.guess_type(self._root.joinpath(path))[0] or DEFAULT_MIMETYPE
 
-    def get_tree(self, path: PathLike | str):
-        return list(filter(lambda path: not path.is_dir(), self._root.joinpath(path).rglob("*")))
+    def get_tree(self, path: PathLike | str, dir_fd: int | None = None) -> list[Path]:
+        # relative to `path`
+        tree = []
+        fd = open_directory(self._at(dir_fd), path)
+
+        try:
+            for directory, _, files, _ in os.fwalk(dir_fd=fd):
+                tree.extend(Path(directory, name) for name in files)
+        finally:
+            os.close(fd)
+
+        return tree
+
+    def get_stat(self, path: PathLike | str, dir_fd: int | None = None):
+        if not split_path(path):  # the root itself
+            return os.stat(self._at(dir_fd))
+
+        with parent_directory(self._at(dir_fd), path) as (fd, name):
+            return os.stat(name, dir_fd=fd, follow_symlinks=False)
+
+    def merge(self, source: PathLike | str, destination: PathLike | str, is_hidden: Callable[[Path], bool],
+              source_dir_fd: int | None = None, destination_dir_fd: int | None = None) -> int:
+        # links whatever of `source` is missing in `destination`, what's already there is kept,
+        # returns the size of what had to be copied instead
+        if not self.is_dir(source, source_dir_fd):
+            if not is_hidden(Path('.')) and not self.exists(destination, destination_dir_fd):
+                with (parent_directory(self._at(source_dir_fd), source) as (source_fd, source_name),
+                      parent_directory(self._at(destination_dir_fd), destination) as (destination_fd, destination_name)):
+                    return _copy_file(source_fd, source_name, destination_fd, destination_name)
+            return 0
+
+        copied = 0
+        self.mkdir(destination, destination_dir_fd)
+
+        source_fd = self.open_directory(source, source_dir_fd)
+        destination_fd = self.open_directory(destination, destination_dir_fd)
+
+        try:
+            for directory, directory_names, file_names, directory_fd in os.fwalk(dir_fd=source_fd):
+                relative = Path(directory)
+                directory_names[:] = [name for name in directory_names if not is_hidden(relative.joinpath(name))]
+
+                for name in directory_names:
+                    self.mkdir(relative.joinpath(name), destination_fd)
+
+                for name in file_names:
+                    if not is_hidden(target := relative.joinpath(name)) and not self.exists(target, destination_fd):
+                        with parent_directory(destination_fd, target) as (fd, target_name):
+                            copied += _copy_file(directory_fd, name, fd, target_name)
+        finally:
+            os.close(source_fd)
+            os.close(destination_fd)
+
+        return copied
+
+    def create_overlay(self, path: PathLike | str) -> Overlay | None:
+        if self._template_cache is None:
+            return None
+
+        return Overlay.create(self._root.joinpath(OVERLAY_DIRECTORY, path),
+                              Path(TEMPLATE_CACHE_DIRECTORY).joinpath(self._template_cache.snapshot()))
+
+    def get_overlay(self, path: PathLike | str) -> Overlay | None:
+        return Overlay.load(self._root.joinpath(OVERLAY_DIRECTORY, path))
+
+    def drop_overlay(self, path: PathLike | str):
+        self._root.joinpath(OVERLAY_DIRECTORY, path).unlink(missing_ok=True)
+
+    def _at(self, dir_fd: int | None) -> int:
+        return self._root_fd if dir_fd is None else dir_fd
+
+    def _get_mode(self, path: PathLike | str, dir_fd: int | None) -> int | None:
+        try:
+            return self.get_stat(path, dir_fd).st_mode
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+
+# files with more than one link are shared with the template cache (and other userspaces),
+# they are replaced instead of being written into
+def _unshare(dir_fd: int, name: str):
+    try:
+        file_stat = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+    except FileNotFoundError:
+        return
+
+    if stat.S_ISREG(file_stat.st_mode) and file_stat.st_nlink > 1:
+        os.unlink(name, dir_fd=dir_fd)
+
+
+def _copy_tree(source_fd: int, destination_fd: int, destination_name: str) -> int:
+    # listed before the copy is created, in case it's created within the source
+    with os.scandir(source_fd) as iterator:
+        entries = [(entry.name, entry.is_dir(follow_symlinks=False), entry.is_file(follow_symlinks=False)) for entry in iterator]
+
+    copied = 0
+    os.mkdir(destination_name, dir_fd=destination_fd)
+    destination_fd = open_directory(destination_fd, destination_name)
+
+    try:
+        for name, is_directory, is_file in entries:
+            if is_directory:
+                child_fd = open_directory(source_fd, name)
+                try:
+                    copied += _copy_tree(child_fd, destination_fd, name)
+                finally:
+                    os.close(child_fd)
+            elif is_file:
+                copied += _copy_file(source_fd, name, destination_fd, name)
+    finally:
+        os.close(destination_fd)
+
+    return copied
+
+
+def _copy_file(source_fd: int, source_name: str, destination_fd: int, destination_name: str) -> int:
+    # returns the size of the copy, or 0 if it's shared (linked) and so not charged for
+    source_stat = os.stat(source_name, dir_fd=source_fd, follow_symlinks=False)
+
+    # shared files stay shared, they are unshared on the first write anyway
+    if source_stat.st_nlink > 1 and _link(source_fd, source_name, destination_fd, destination_name):
+        return 0
+
+    _unshare(destination_fd, destination_name)
+
+    with (open(os.open(source_name, os.O_RDONLY | FILE_FLAGS, dir_fd=source_fd), 'rb') as source,
+          open(os.open(destination_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | FILE_FLAGS, 0o666, dir_fd=destination_fd), 'wb') as destination):
+        shutil.copyfileobj(source, destination, COPY_BUFFER_SIZE)
+
+        # like `shutil.copy2`
+        os.fchmod(destination.fileno(), stat.S_IMODE(source_stat.st_mode))
+        os.utime(destination.fileno(), ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+
+    return source_stat.st_size
+
+
+def _link(source_fd: int, source_name: str, destination_fd: int, destination_name: str) -> bool:
+    try:
+        os.unlink(destination_name, dir_fd=destination_fd)
+    except FileNotFoundError:
+        pass
+
+    try:
+        os.link(source_name, destination_name, src_dir_fd=source_fd, dst_dir_fd=destination_fd, follow_symlinks=False)
+    except OSError:  # out of links, or a filesystem without hardlinks, it's copied (and charged) then
+        return False
+
+    return True
+
+
+def _get_directory_size(dir_fd: int, name: str) -> int:
+    size = 0
+
+    for _, _, files, directory_fd in os.fwalk(name, dir_fd=dir_fd):
+        for file in files:
+            size += _get_charged_size(os.stat(file, dir_fd=directory_fd, follow_symlinks=False))
 
-    def get_stat(self, path: PathLike | str):
-        return self._root.joinpath(path).stat()
+    return size
 
-    def deploy_template(self, path: PathLike | str):
-        if self._template is None:
-            return
 
-        shutil.copytree(self._template, self._root.joinpath(path), dirs_exist_ok=True)
+def _get_charged_size(file_stat: os.stat_result) -> int:
+    return file_stat.st_size if stat.S_ISREG(file_stat.st_mode) and file_stat.st_nlink == 1 else 0
@@ -0,0 +1,64 @@
+import errno
+import os
+import stat
+from contextlib import contextmanager
+from os import PathLike
+from typing import Iterator
+
+# paths are opened one component at a time relative to a directory descriptor, never following symlinks,
+# so that checking that a path stays beneath the directory and using it can't race each other
+
+DIRECTORY_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+
+
+def split_path(path: PathLike | str) -> list[str]:
+    # `..` is resolved lexically, which is sound only because no symlink is ever followed
+    parts = os.path.normpath(path).split(os.sep)
+
+    if os.path.isabs(path) or parts[0] == '..':
+        raise ValueError("path breaks out of the filesystem")
+
+    return [part for part in parts if part != '.']
+
+
+def open_directory(dir_fd: int, path: PathLike | str) -> int:
+    fd = os.dup(dir_fd)
+
+    try:
+        for part in split_path(path):
+            fd, parent_fd = _open_child(fd, part), fd
+            os.close(parent_fd)
+    except BaseException:
+        os.close(fd)
+        raise
+
+    return fd
+
+
+@contextmanager
+def parent_directory(dir_fd: int, path: PathLike | str) -> Iterator[tuple[int, str]]:
+    # the directory (descriptor) the last component of `path` is in, and that component
+    if not (parts := split_path(path)):
+        raise ValueError("the root has no parent directory")
+
+    *directories, name = parts
+    fd = open_directory(dir_fd, os.path.join('.', *directories))
+
+    try:
+        yield fd, name
+    finally:
+        os.close(fd)
+
+
+def _open_child(fd: int, name: str) -> int:
+    try:
+        return os.open(name, DIRECTORY_FLAGS, dir_fd=fd)
+    except OSError as e:
+        # a symlink, which may lead anywhere (linux reports it as not being a directory)
+        if e.errno == errno.ELOOP or (e.errno == errno.ENOTDIR and is_symlink(fd, name)):
+            raise ValueError("path breaks out of the filesystem")
+        raise
+
+
+def is_symlink(dir_fd: int, name: str) -> bool:
+    return stat.S_ISLNK(os.stat(name, dir_fd=dir_fd, follow_symlinks=False).st_mode)
@@ -0,0 +1,70 @@
+import os
+import threading
+from os import PathLike
+from pathlib import Path
+from typing import Callable
+
+
+class UsageLedger:
+    _root: Path
+    _usage: dict[str, int]
+    _lock: threading.Lock
+
+    def __init__(self, root_path: PathLike | str):
+        self._root = Path(root_path)
+        self._usage = {}
+        self._lock = threading.Lock()
+
+        self._root.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key: str, measure: Callable[[], int]) -> int:
+        with self._lock:
+            return self._get(key, measure)
+
+    # unsaved changes are kept in memory only, until the next saved one
+    def reserve(self, key: str, delta: int, limit: int, measure: Callable[[], int], is_saved: bool = True):
+        with self._lock:
+            usage = self._get(key, measure)
+
+            if delta > 0 and usage + delta > limit:
+                raise RuntimeError("data is too large (not enough space)")
+
+            self._set(key, usage + delta, is_saved)
+
+    def adjust(self, key: str, delta: int, measure: Callable[[], int], is_saved: bool = True):
+        with self._lock:
+            self._set(key, max(self._get(key, measure) + delta, 0), is_saved)
+
+    def reset(self, key: str, usage: int):
+        with self._lock:
+            self._set(key, usage)
+
+    def drop(self, key: str):
+        with self._lock:
+            self._usage.pop(key, None)
+            self._root.joinpath(key).unlink(missing_ok=True)
+
+    def _get(self, key: str, measure: Callable[[], int]) -> int:
+        if key in self._usage:
+            return self._usage[key]
+
+        try:
+            usage = int(self._root.joinpath(key).read_text())
+        except (FileNotFoundError, ValueError):
+            # no (valid) record yet, e.g. userspace created before the ledger existed
+            self._set(key, usage := measure())
+        else:
+            self._usage[key] = usage
+
+        return usage
+
+    def _set(self, key: str, usage: int, is_saved: bool = True):
+        self._usage[key] = usage
+
+        if not is_saved:
+            return
+
+        record = self._root.joinpath(key)
+        temporary = record.with_name(f'{key}.tmp')
+        temporary.write_text(str(usage))
+        os.replace(temporary, record)
@@ -0,0 +1,63 @@
+import json
+import os
+import threading
+from os import PathLike
+from pathlib import Path
+
+
+_lock = threading.Lock()
+
+
+# the template snapshot a userspace reads through to, and the template paths the user has removed (whiteouts)
+class Overlay:
+    _record: Path
+    _lower: Path
+    _whiteouts: set[Path]
+
+    def __init__(self, record_path: PathLike | str, lower_path: PathLike | str, whiteouts: set[Path]):
+        self._record = Path(record_path)
+        self._lower = Path(lower_path)
+        self._whiteouts = whiteouts
+
+    @classmethod
+    def create(cls, record_path: PathLike | str, lower_path: PathLike | str) -> 'Overlay':
+        overlay = cls(record_path, lower_path, set())
+        overlay._save()
+
+        return overlay
+
+    @classmethod
+    def load(cls, record_path: PathLike | str) -> 'Overlay | None':
+        try:
+            record = json.loads(Path(record_path).read_text())
+        except FileNotFoundError:  # userspace created before overlays, or without a template
+            return None
+
+        return cls(record_path, record['lower'], set(map(Path, record['whiteouts'])))
+
+    def get_lower(self) -> Path:
+        return self._lower
+
+    def is_whited_out(self, path: PathLike | str) -> bool:
+        parts = _normalize(path).parts
+        return any(Path(*parts[:i]) in self._whiteouts for i in range(1, len(parts) + 1))
+
+    def add_whiteout(self, path: PathLike | str):
+        with _lock:
+            # other instances of the same userspace may have added some meanwhile
+            if (current := Overlay.load(self._record)) is not None:
+                self._whiteouts |= current._whiteouts
+
+            self._whiteouts.add(_normalize(path))
+            self._save()
+
+    def _save(self):
+        self._record.parent.mkdir(parents=True, exist_ok=True)
+
+        temporary = self._record.with_name(f'{self._record.name}.tmp')
+        temporary.write_text(json.dumps({'lower': str(self._lower), 'whiteouts': sorted(map(str, self._whiteouts))}))
+        os.replace(temporary, self._record)
+
+
+def _normalize(path: PathLike | str) -> Path:
+    return Path(os.path.normpath(path))
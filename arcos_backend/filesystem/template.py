@@ -0,0 +1,94 @@
+import errno
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from os import PathLike
+from pathlib import Path
+
+
+SNAPSHOT_DIRECTORY = 'versions'
+
+
+# the template files are stored once by their content, and every version of the template is a snapshot of hardlinks to them,
+# a changed template only adds a snapshot, so the userspaces created before keep seeing the old one
+class TemplateCache:
+    _template: Path
+    _root: Path
+    _snapshot: Path | None
+
+    def __init__(self, template_path: PathLike | str, root_path: PathLike | str):
+        self._template = Path(template_path)
+        self._root = Path(root_path)
+        self._snapshot = None
+
+        self._root.joinpath(SNAPSHOT_DIRECTORY).mkdir(parents=True, exist_ok=True)
+
+    def snapshot(self) -> Path:
+        # taken once per process, so the template is read at most once and changes to it are picked up on restart
+        if self._snapshot is None:
+            self._snapshot = self._take_snapshot()
+
+        return self._snapshot
+
+    def _take_snapshot(self) -> Path:
+        directories, files = [], {}
+
+        for directory, _, names in os.walk(self._template):
+            directories.append(Path(directory).relative_to(self._template))
+
+            for name in names:
+                files[directories[-1].joinpath(name)] = self._get_object(Path(directory, name))
+
+        version = hashlib.sha256(json.dumps(sorted([str(path), object_path.name] for path, object_path in files.items())).encode()).hexdigest()
+        snapshot = Path(SNAPSHOT_DIRECTORY, version)
+
+        if not (destination := self._root.joinpath(snapshot)).exists():
+            # built aside and renamed into place, so that a snapshot is never seen half done
+            temporary = destination.with_name(f'.{version}.{uuid.uuid4().hex}.part')
+
+            for directory in directories:
+                temporary.joinpath(directory).mkdir(parents=True, exist_ok=True)
+
+            for path, object_path in files.items():
+                link(object_path, temporary.joinpath(path))
+
+            try:
+                os.rename(temporary, destination)
+            except OSError:  # taken by another process meanwhile
+                shutil.rmtree(temporary)
+
+        return snapshot
+
+    def _get_object(self, path: Path) -> Path:
+        with path.open('rb') as file:
+            object_path = self._root.joinpath(hashlib.file_digest(file, 'sha256').hexdigest())
+
+        if not object_path.exists():
+            store(path, object_path)
+
+        return object_path
+
+
+def link(source: Path, destination: Path):
+    destination.unlink(missing_ok=True)
+
+    try:
+        os.link(source, destination)
+    except OSError as e:
+        if e.errno != errno.EMLINK:
+            # e.g. a filesystem without hardlinks, the file is simply copied (and charged to the user)
+            shutil.copyfile(source, destination)
+            return
+
+        # the inode ran out of links, the ones linked later share a fresh copy of it
+        store(source, source)
+        os.link(source, destination)
+
+
+def store(source: Path, destination: Path):
+    temporary = destination.with_name(f'.{destination.name}.{uuid.uuid4().hex}.part')
+
+    shutil.copyfile(source, temporary)
+    os.replace(temporary, destination)
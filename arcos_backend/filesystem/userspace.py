@@ -1,97 +1,392 @@
+import os
+import threading
+import weakref
+from collections import OrderedDict
 from os import PathLike
 from pathlib import Path
+from typing import BinaryIO
 
 from arcos_backend import Filesystem
+from arcos_backend._metrics import filesystem_bytes, metrics, CallbackMetric
+from arcos_backend._shared import configuration as cfg, filesystem
+from arcos_backend.filesystem import DirectoryEntry
+from arcos_backend.filesystem.confine import split_path
+from arcos_backend.filesystem.overlay import Overlay
 
 
+UPLOAD_RESERVATION_SIZE = 4 * 1024 * 1024
+
+
+# the template isn't copied into the userspace, it's read through to (the lower layer) until the user changes it,
+# then the affected part of it is linked into the userspace (the upper layer), which costs no quota until written
+# every path is opened relative to the userspace's root descriptor, which confines it to the userspace (see `confine`)
 # TODO make it inherit `Filesystem` instead
 class Userspace:
     _id: int
     _fs: Filesystem
     _path_id: Path
     _root: Path
+    # kept open for as long as the userspace is, closed once it's garbage collected
+    _root_fd: int
+    _overlay: Overlay | None
+    _lower_fd: int | None
 
     def __init__(self, fs: Filesystem, id: int):
         self._fs = fs
         self._id = id
         self._path_id = Path(str(id))
-        self._root = self._fs.get_root().joinpath(str(id))
+        self._root = self._fs.get_root().joinpath(str(id)).resolve()
+
+        if not self._fs.exists(self._path_id):
+            self._fs.mkdir(self._path_id)
+            self._overlay = self._fs.create_overlay(self._path_id)
+            self.reconcile_usage()
+        else:
+            self._overlay = self._fs.get_overlay(self._path_id)
 
-        if not self._root.exists():
-            self._root.mkdir(parents=True)
-            self.deploy_template('.')
+        self._root_fd = self._fs.open_directory(self._path_id)
+        weakref.finalize(self, os.close, self._root_fd)
+
+        self._lower_fd = None
+        if self._overlay is not None:
+            self._lower_fd = self._fs.open_directory(self._overlay.get_lower())
+            weakref.finalize(self, os.close, self._lower_fd)
 
     def get_root(self):
         return self._root
 
     def delete(self):
-        self._fs.remove(str(self._id))
+        self._fs.remove(self._path_id)
+        self._fs.drop_usage(self._path_id)
+        self._fs.drop_overlay(self._path_id)
 
     def mkdir(self, path: PathLike | str):
-        self._validate(path)
-        self._fs.mkdir(self._path_id.joinpath(path))
+        if self._is_in_lower(path) and not self._fs.is_dir(path, self._lower_fd):
+            raise FileExistsError(f"{path} already exists")
+
+        self._materialize_directory(Path(path).parent)
+        self._fs.mkdir(path, self._root_fd)
 
     def listdir(self, path: PathLike | str):
-        self._validate(path)
-        files, directories = self._fs.listdir(self._path_id.joinpath(path))
+        files, directories = [], []
 
-        files = [self._scope(file) for file in files]
-        directories = [self._scope(directory) for directory in directories]
+        for entry in self.scandir(path):
+            (directories if entry.is_directory else files).append(Path(path, entry.name))
 
         return files, directories
 
+    def scandir(self, path: PathLike | str) -> list[DirectoryEntry]:
+        entries, is_found = {}, False
+
+        for layer_fd in self._get_layers(path):
+            try:
+                layer_entries = self._fs.scandir(path, layer_fd)
+            except FileNotFoundError:  # the directory is only in the template
+                continue
+
+            is_found = True
+            is_upper = layer_fd == self._root_fd
+
+            entries.update((entry.name, entry) for entry in layer_entries if is_upper or not self._overlay.is_whited_out(Path(path, entry.name)))
+
+        if not is_found:
+            raise FileNotFoundError(f"{path} doesn't exist")
+
+        return list(entries.values())
+
     def write(self, path: PathLike | str, data: bytes):
-        self._validate(path)
-        
-        if self.get_size('.') + len(data) > self._userspace_size:
-            raise RuntimeError("data is too large (not enough space)")
-        
-        self._fs.write(self._path_id.joinpath(path), data)
+        self._prepare(path)
+
+        delta = len(data) - self._get_overwritten_size(path)
+
+        self._fs.reserve_usage(self._path_id, delta)
+        try:
+            self._fs.write(path, data, self._root_fd)
+        except BaseException:
+            self._fs.adjust_usage(self._path_id, -delta)
+            raise
+
+        filesystem_bytes.inc('write', amount=len(data))
+
+    def upload(self, path: PathLike | str) -> 'Upload':
+        self._prepare(path)
+        return Upload(self, path)
 
     def remove(self, path: PathLike | str):
-        self._validate(path)
-        self._fs.remove(self._path_id.joinpath(path))
+        is_in_lower = self._is_in_lower(path)
+
+        # only hidden, if it's just in the template
+        if not is_in_lower or self._fs.exists(path, self._root_fd):
+            size = self._fs.get_size(path, self._root_fd)
+            self._fs.remove(path, self._root_fd)
+            self._fs.adjust_usage(self._path_id, -size)
+
+        if is_in_lower:
+            self._overlay.add_whiteout(path)
 
     def move(self, source: PathLike | str, destination: PathLike | str):
-        self._validate(source, destination)
-        self._fs.move(self._path_id.joinpath(source),
-                      self._path_id.joinpath(destination))
+        if (target := self._get_target(source, destination)) is not None:
+            if self._fs.exists(target, self._root_fd) or self._is_in_lower(target):
+                raise FileExistsError(f"{target} already exists")
+
+            destination = target
+
+        is_in_lower = self._is_in_lower(source)
+        self._materialize(source)
+        self._prepare(destination)
+
+        # moving within the userspace only frees the file it overwrites (if any)
+        freed = self._get_overwritten_size(destination) if self._fs.is_file(source, self._root_fd) else 0
+
+        self._fs.move(source, destination, self._root_fd)
+        self._fs.adjust_usage(self._path_id, -freed)
+
+        if is_in_lower:
+            self._overlay.add_whiteout(source)
 
     def copy(self, source: PathLike | str, destination: PathLike | str):
-        self._validate(source, destination)
-        self._fs.copy(self._path_id.joinpath(source),
-                      self._path_id.joinpath(destination))
+        # directories are copied only to a new path
+        if self._fs.is_file(source, self._resolve(source)) and (target := self._get_target(source, destination)) is not None:
+            destination = target
+
+        self._materialize(source)
+        self._prepare(destination)
+
+        delta = size = self._fs.get_size(source, self._root_fd)
+        if self._fs.is_file(source, self._root_fd):
+            delta -= self._get_overwritten_size(destination)
+
+        self._fs.reserve_usage(self._path_id, delta)
+        try:
+            copied = self._fs.copy(source, destination, self._root_fd)
+        except BaseException:
+            self._fs.adjust_usage(self._path_id, -delta)
+            raise
+
+        # shared files that couldn't be linked were copied, and are charged like the rest
+        if copied != size:
+            self._fs.adjust_usage(self._path_id, copied - size)
+
+        filesystem_bytes.inc('copy', amount=copied)
 
     def read(self, path: PathLike | str) -> bytes:
-        self._validate(path)
-        return self._fs.read(self._path_id.joinpath(path))
+        data = self._fs.read(path, self._resolve(path))
+        filesystem_bytes.inc('read', amount=len(data))
+
+        return data
+
+    def open_read(self, path: PathLike | str) -> BinaryIO:
+        return self._fs.open_read(path, self._resolve(path))
 
     def get_size(self, path: PathLike | str) -> int:
-        self._validate(path)
-        return self._fs.get_size(self._path_id.joinpath(path))
+        # what the userspace is charged for, the template isn't
+        return self._fs.get_size(path, self._root_fd)
+
+    def get_usage(self) -> int:
+        return self._fs.get_usage(self._path_id)
+
+    def reconcile_usage(self) -> int:
+        return self._fs.reconcile_usage(self._path_id)
 
     def get_mime(self, path: PathLike | str) -> str:
-        self._validate(path)
-        return self._fs.get_mime(self._path_id.joinpath(path))
+        return self._fs.get_mime(self.normalize(path))
 
     def get_tree(self, path: PathLike | str):
-        self._validate(path)
-        return [self._scope(path, 4) for path in self._fs.get_tree(self._path_id.joinpath(path))]
+        tree, is_found = {}, False
 
-    def get_stat(self, path: PathLike | str):
-        self._validate(path)
-        return self._fs.get_stat(self._path_id.joinpath(path))
+        for layer_fd in self._get_layers(path):
+            try:
+                files = self._fs.get_tree(path, layer_fd)
+            except FileNotFoundError:
+                continue
 
-    def deploy_template(self, path: PathLike | str):
-        self._validate(path)
-        self._fs.deploy_template(self._path_id.joinpath(path))
+            is_found = True
+            is_upper = layer_fd == self._root_fd
+
+            tree.update((Path(path, file), None) for file in files if is_upper or not self._overlay.is_whited_out(Path(path, file)))
+
+        if not is_found:
+            raise FileNotFoundError(f"{path} doesn't exist")
+
+        return list(tree)
+
+    def get_stat(self, path: PathLike | str):
+        return self._fs.get_stat(path, self._resolve(path))
 
     @staticmethod
-    def _scope(path: PathLike | str, level: int = 2):
-        return (path := Path(path)).relative_to(path.parents[-level])
-
-    def _validate(self, *paths: PathLike | str):
-        for path in paths:
-            requested_path = self._root.joinpath(path)
-            if not requested_path.resolve().is_relative_to(self._root.absolute()):
-                raise ValueError("path breaks out of the filesystem")
+    def normalize(path: PathLike | str) -> Path:
+        return Path(*split_path(path))
+
+    def _is_in_lower(self, path: PathLike | str) -> bool:
+        return self._overlay is not None and not self._overlay.is_whited_out(path) and self._fs.exists(path, self._lower_fd)
+
+    def _get_layers(self, path: PathLike | str) -> list[int]:
+        # the lower one first, so that the upper one overrides it
+        return [self._lower_fd, self._root_fd] if self._is_in_lower(path) else [self._root_fd]
+
+    def _resolve(self, path: PathLike | str) -> int:
+        return self._lower_fd if not self._fs.exists(path, self._root_fd) and self._is_in_lower(path) else self._root_fd
+
+    def _get_target(self, source: PathLike | str, destination: PathLike | str) -> Path | None:
+        # like `Filesystem.move` and `.copy`, into the destination if it's a directory, which may be only in the template
+        if self._fs.is_dir(destination, self._resolve(destination)):
+            return Path(destination, self.normalize(source).name)
+
+        return None
+
+    def _prepare(self, path: PathLike | str):
+        # something is about to be put at `path`
+        self._materialize_directory(Path(path).parent)
+        self._materialize_directory(path)
+
+    def _materialize_directory(self, path: PathLike | str):
+        if not self._fs.exists(path, self._root_fd) and self._is_in_lower(path) and self._fs.is_dir(path, self._lower_fd):
+            self._materialize_directory(Path(path).parent)
+            self._fs.mkdir(path, self._root_fd)
+
+    def _materialize(self, path: PathLike | str):
+        if not self._is_in_lower(path):
+            return
+
+        self._materialize_directory(Path(path).parent)
+        # the template files that couldn't be linked were copied, those are charged
+        if copied := self._fs.merge(path, path, lambda relative: self._overlay.is_whited_out(Path(path, relative)), self._lower_fd, self._root_fd):
+            self._fs.adjust_usage(self._path_id, copied)
+
+    def _get_overwritten_size(self, path: PathLike | str) -> int:
+        return self._fs.get_size(path, self._root_fd) if self._fs.is_file(path, self._root_fd) else 0
+
+
+# writes the file chunk by chunk into a temporary file, which replaces the destination only on commit
+# the space is reserved in memory as the upload goes, the ledger is saved once it's committed or discarded
+class Upload:
+    _userspace: Userspace
+    _path: Path
+    _temporary: Path
+    _file: BinaryIO
+    _overwritten: int
+    _written: int
+    _reserved: int
+    _is_finished: bool
+
+    def __init__(self, userspace: Userspace, path: PathLike | str):
+        self._userspace = userspace
+        self._path = Path(path)
+        self._overwritten = userspace._get_overwritten_size(path)
+        self._written = 0
+        self._reserved = 0
+        self._is_finished = False
+
+        self._temporary, self._file = userspace._fs.open_temporary(self._path, userspace._root_fd)
+
+    def reserve(self, size: int):
+        # for the whole file upfront, when its size is known
+        if (needed := size - self._overwritten - self._reserved) > 0:
+            self._reserve(needed)
+
+    def write(self, chunk: bytes):
+        self._written += len(chunk)
+
+        # only bytes beyond the size of the overwritten file take up new space
+        if (needed := self._written - self._overwritten - self._reserved) > 0:
+            try:
+                self._reserve(max(needed, UPLOAD_RESERVATION_SIZE))
+            except RuntimeError:  # close to the quota, what's left may still do
+                self._reserve(needed)
+
+        self._file.write(chunk)
+        filesystem_bytes.inc('upload', amount=len(chunk))
+
+    def commit(self):
+        fs = self._userspace._fs
+
+        self._file.close()
+        fs.replace(self._temporary, self._path, self._userspace._root_fd)
+        fs.adjust_usage(self._userspace._path_id, self._written - self._overwritten - self._reserved)
+
+        self._is_finished = True
+
+    def discard(self):
+        if self._is_finished:
+            return
+
+        fs = self._userspace._fs
+
+        self._file.close()
+        fs.remove(self._temporary, self._userspace._root_fd)
+        fs.adjust_usage(self._userspace._path_id, -self._reserved)
+
+        self._is_finished = True
+
+    def _reserve(self, size: int):
+        self._userspace._fs.reserve_usage(self._userspace._path_id, size, is_saved=False)
+        self._reserved += size
+
+
+# userspaces of recently active users, so that a request doesn't have to set one up
+class UserspaceRegistry:
+    _fs: Filesystem
+    _size: int
+    _userspaces: OrderedDict[int, Userspace]
+    _lock: threading.Lock
+
+    hits: int
+    misses: int
+
+    def __init__(self, fs: Filesystem, size: int):
+        self._fs = fs
+        self._size = size
+        self._userspaces = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, id: int) -> Userspace:
+        with self._lock:
+            if (userspace := self._userspaces.get(id)) is not None:
+                self._userspaces.move_to_end(id)
+                self.hits += 1
+
+                return userspace
+
+            self.misses += 1
+
+        # set up outside of the lock, as a new userspace is created on the disk
+        userspace = Userspace(self._fs, id)
+
+        if self._size <= 0:
+            return userspace
+
+        with self._lock:
+            # another request may have set it up meanwhile
+            userspace = self._userspaces.setdefault(id, userspace)
+            self._userspaces.move_to_end(id)
+
+            # the evicted ones are closed once the requests still using them are done
+            while len(self._userspaces) > self._size:
+                self._userspaces.popitem(last=False)
+
+        return userspace
+
+    def discard(self, id: int):
+        with self._lock:
+            self._userspaces.pop(id, None)
+
+    def get_hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get_stats(self) -> dict:
+        return {
+            'size': len(self._userspaces),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+userspaces = UserspaceRegistry(filesystem, cfg['filesystem']['userspace_cache_size'])
+
+metrics.register(CallbackMetric("arcapi_userspace_cache_hits_total", "Userspaces reused from the registry", lambda: userspaces.hits, 'counter'))
+metrics.register(CallbackMetric("arcapi_userspace_cache_misses_total", "Userspaces set up for a request", lambda: userspaces.misses, 'counter'))
+metrics.register(CallbackMetric("arcapi_userspace_cache_hit_ratio", "Share of requests reusing a userspace", userspaces.get_hit_ratio))
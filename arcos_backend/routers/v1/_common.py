@@ -1,12 +1,13 @@
 import base64
 from typing import Annotated
 
-from fastapi import HTTPException, Header, Depends
+from fastapi import HTTPException, Header, Depends, Request
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from ..._shared import configuration as cfg
 from ...davult import models
-from ...davult.database import LocalSession
+from ...davult.database import LocalSession, ReadSession, AsyncLocalSession, AsyncReadSession
 from ...davult.crud import token as token_db, user as user_db
 
 
@@ -18,6 +19,25 @@ def get_db() -> Session:
         db.close()
 
 
+# for endpoints that never write, see `read_pool` in the config
+def get_read_db() -> Session:
+    db = ReadSession()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_db() -> AsyncSession:
+    async with AsyncLocalSession() as db:
+        yield db
+
+
+async def get_async_read_db() -> AsyncSession:
+    async with AsyncReadSession() as db:
+        yield db
+
+
 def auth_basic(authorization: Annotated[str, Header()]) -> tuple[str, str]:
     if not authorization.startswith('Basic '):
         raise HTTPException(status_code=422, detail="invalid authorization method")
@@ -27,26 +47,45 @@ def auth_basic(authorization: Annotated[str, Header()]) -> tuple[str, str]:
     return username.strip(), password
 
 
-def auth_bearer(db: Annotated[Session, Depends(get_db)], authorization: Annotated[str, Header()]) -> models.User:
-    if not authorization.startswith('Bearer '):
-        raise HTTPException(status_code=422, detail="invalid authorization method")
-
+def auth_bearer(request: Request, db: Annotated[Session, Depends(get_db)], authorization: Annotated[str, Header()]) -> models.User:
     try:
-        token = token_db.find_token(db, authorization[7:])
-    except LookupError:
+        user = token_db.authenticate(db, _get_bearer_token(authorization))
+    except (ValueError, LookupError):
         raise HTTPException(status_code=403, detail="invalid token")
 
-    if token is None:
-        raise HTTPException(status_code=403, detail="invalid token")
+    # for the access log
+    request.state.user_id = user.id
+
+    return user
 
+
+# the user is bound to the async session, so only endpoints using `get_async_db` may modify it
+async def auth_bearer_async(request: Request, db: Annotated[AsyncSession, Depends(get_async_db)], authorization: Annotated[str, Header()]) -> models.User:
+    return await _authenticate_async(request, db, authorization)
+
+
+async def auth_bearer_read(request: Request, db: Annotated[AsyncSession, Depends(get_async_read_db)], authorization: Annotated[str, Header()]) -> models.User:
+    return await _authenticate_async(request, db, authorization, expire=False)
+
+
+async def _authenticate_async(request: Request, db: AsyncSession, authorization: str, expire: bool = True) -> models.User:
     try:
-        user = token_db.validate_token(db, token)
+        user = await token_db.authenticate_async(db, _get_bearer_token(authorization), expire)
     except (ValueError, LookupError):
         raise HTTPException(status_code=403, detail="invalid token")
 
+    request.state.user_id = user.id
+
     return user
 
 
+def _get_bearer_token(authorization: str) -> str:
+    if not authorization.startswith('Bearer '):
+        raise HTTPException(status_code=422, detail="invalid authorization method")
+
+    return authorization[7:]
+
+
 def auth_admin(authorization: Annotated[str, Header()]):
     admin_code = cfg['security']['admin_code']
 
@@ -73,3 +112,13 @@ def user_identification(db: Annotated[Session, Depends(get_db)], name: str | Non
         return user_db.find_user(db, name)
     else:
         return user_db.get_user(db, id)
+
+
+async def user_identification_async(db: Annotated[AsyncSession, Depends(get_async_db)], name: str | None = None, id: int | None = None) -> models.User:
+    if not ((name is None) ^ (id is None)):
+        raise HTTPException(status_code=422, detail="provide only either name or id")
+
+    if name:
+        return await user_db.find_user_async(db, name)
+    else:
+        return await user_db.get_user_async(db, id)
@@ -0,0 +1,122 @@
+import os
+from email.utils import parsedate_to_datetime
+from os import PathLike
+from typing import BinaryIO
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.types import Scope, Receive, Send
+
+from ..._metrics import filesystem_bytes
+
+
+class RangeFileResponse(FileResponse):
+    # streams the already opened `file` (closed once sent), `path` is only its name,
+    # expects `stat_result` to be given (of that file), so that the validator headers are always present
+    _file: BinaryIO
+
+    def __init__(self, file: BinaryIO, path: PathLike | str, **kwargs):
+        self._file = file
+        super().__init__(path, **kwargs)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await self._respond(scope, send)
+        finally:
+            self._file.close()
+
+    async def _respond(self, scope: Scope, send: Send):
+        request_headers = Headers(scope=scope)
+        size = self.stat_result.st_size
+
+        if self._is_not_modified(request_headers):
+            self.status_code = 304
+            await self._send_empty(send, [(k, v) for k, v in self.raw_headers if k in (b'etag', b'last-modified')])
+            return
+
+        self.headers['accept-ranges'] = 'bytes'
+        start, end = 0, size
+
+        if (requested_range := self._get_requested_range(request_headers)) is not None:
+            try:
+                start, end = _parse_range(requested_range, size)
+            except ValueError:
+                self.status_code = 416
+                await self._send_empty(send, [(b'content-range', f'bytes */{size}'.encode('latin-1')), (b'content-length', b'0')])
+                return
+
+            self.status_code = 206
+            self.headers['content-range'] = f'bytes {start}-{end - 1}/{size}'
+            self.headers['content-length'] = str(end - start)
+
+        await send({
+            'type': 'http.response.start',
+            'status': self.status_code,
+            'headers': self.raw_headers
+        })
+
+        if scope['method'].upper() == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+
+        offset = start
+        while offset < end:
+            chunk = await anyio.to_thread.run_sync(os.pread, self._file.fileno(), min(self.chunk_size, end - offset), offset)
+            if not chunk:
+                break  # the file has been truncated in the meantime
+
+            offset += len(chunk)
+            filesystem_bytes.inc('download', amount=len(chunk))
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': offset < end})
+
+        if offset < end:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    def _is_not_modified(self, request_headers: Headers) -> bool:
+        if (if_none_match := request_headers.get('if-none-match')) is not None:
+            etag = self.headers['etag']
+            return any(tag.strip().removeprefix('W/') in (etag, '*') for tag in if_none_match.split(','))
+
+        if (if_modified_since := request_headers.get('if-modified-since')) is not None:
+            try:
+                return int(self.stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+
+        return False
+
+    def _get_requested_range(self, request_headers: Headers) -> str | None:
+        if (requested_range := request_headers.get('range')) is None:
+            return None
+
+        # the range only applies if the client's copy is still the current one
+        if_range = request_headers.get('if-range')
+        if if_range is not None and if_range not in (self.headers['etag'], self.headers['last-modified']):
+            return None
+
+        unit, _, ranges = requested_range.partition('=')
+
+        # multipart ranges are not supported - those are answered with the whole file instead
+        if unit.strip().lower() != 'bytes' or ',' in ranges:
+            return None
+
+        return ranges
+
+    async def _send_empty(self, send: Send, headers: list[tuple[bytes, bytes]]):
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+def _parse_range(requested_range: str, size: int) -> tuple[int, int]:
+    first, _, last = requested_range.strip().partition('-')
+
+    if not first:
+        start, end = max(size - int(last), 0), size
+    else:
+        start, end = int(first), min(int(last) + 1, size) if last else size
+
+    if start >= end or start < 0:
+        raise ValueError("unsatisfiable range")
+
+    return start, end
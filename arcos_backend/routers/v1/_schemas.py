@@ -1,6 +1,7 @@
 from datetime import datetime
+from typing import Literal
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Base64Bytes, Base64Str
 
 
 class UserEdit(BaseModel):
@@ -14,3 +15,14 @@ class UserData(BaseModel):
     properties: dict
     creation_time: datetime
     is_deleted: bool
+
+
+class FilesystemOperation(BaseModel):
+    op: Literal['dir/create', 'file/write', 'cp', 'rm', 'rename']
+    path: Base64Str
+    target: Base64Str | None = None  # `cp` and `rename`
+    data: Base64Bytes = b''  # `file/write`
+
+
+class FilesystemBatch(BaseModel):
+    operations: list[FilesystemOperation]
@@ -1,16 +1,22 @@
-import json
 from typing import Annotated
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import PlainTextResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from starlette.requests import Request
 
 from . import user as user_api
-from ._common import get_db, auth_admin, user_identification
+from ._common import get_db, get_async_db, auth_admin, user_identification, user_identification_async
 from ._schemas import UserEdit, UserData
 from .. import EndpointTags
+from ..._metrics import metrics
+from ..._shared import configuration as cfg
 from ...davult import models
+from ...davult.buffer import properties_buffer
+from ...davult.cache import token_cache
 from ...davult.crud import user as user_db
+from ...filesystem.userspace import userspaces
 
 
 router = APIRouter(tags=[EndpointTags.admin])
@@ -22,12 +28,13 @@ def admin_delete(request: Request, _: Annotated[None, Depends(auth_admin)], db:
 
 
 @router.patch('/user', summary="Changes access properties of the given user")
-def admin_change_user(_: Annotated[None, Depends(auth_admin)], db: Annotated[Session, Depends(get_db)], edit: UserEdit, user: Annotated[models.User, Depends(user_identification)]):
+async def admin_change_user(_: Annotated[None, Depends(auth_admin)], db: Annotated[AsyncSession, Depends(get_async_db)], edit: UserEdit,
+                            user: Annotated[models.User, Depends(user_identification_async)]):
     if edit.password is not None:
-        user_db.set_user_password(db, user, edit.password)
+        await user_db.set_user_password_async(db, user, edit.password)
 
     if edit.state is not None:
-        user_db.set_user_state(db, user, edit.state)
+        await user_db.set_user_state_async(db, user, edit.state)
 
 
 @router.get('/user', summary="Get user's data")
@@ -36,7 +43,36 @@ def admin_get_user(_: Annotated[None, Depends(auth_admin)], user: Annotated[mode
     return UserData(
         id=user.id,
         username=user.username,
-        properties=json.loads(user.properties),
+        properties=properties_buffer.get(user)[0],
         creation_time=user.creation_time,
         is_deleted=user.is_deleted,
     )
+
+
+@router.get('/user/quota/reconcile', summary="Rebuild user's storage usage from disk")
+def admin_reconcile_quota(_: Annotated[None, Depends(auth_admin)], user: Annotated[models.User, Depends(user_identification)]):
+    return {
+        'data': {
+            'used': userspaces.get(user.id).reconcile_usage()
+        },
+        'valid': True
+    }
+
+
+@router.get('/stats', summary="Get statistics of the internal caches")
+def admin_stats(_: Annotated[None, Depends(auth_admin)]):
+    return {
+        'data': {
+            'tokenCache': token_cache.get_stats(),
+            'userspaceCache': userspaces.get_stats()
+        },
+        'valid': True
+    }
+
+
+@router.get('/metrics', summary="Get metrics in the Prometheus text format", response_class=PlainTextResponse)
+def admin_metrics(_: Annotated[None, Depends(auth_admin)]):
+    if not cfg['metrics']['enabled']:
+        raise HTTPException(status_code=404, detail="metrics are disabled")
+
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
@@ -1,18 +1,22 @@
 import os
+import stat
 import base64
 from pathlib import Path
 from typing import Annotated
 
-from fastapi import APIRouter, HTTPException, Response, Depends
+from fastapi import APIRouter, HTTPException, Depends
+from starlette.concurrency import run_in_threadpool
 from starlette.requests import Request
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 
-from ._common import auth_bearer, get_path, adapt_timestamp
+from ._common import auth_bearer, auth_bearer_read, get_path, adapt_timestamp
+from ._responses import RangeFileResponse
+from ._schemas import FilesystemBatch, FilesystemOperation
 from .. import EndpointTags
-from ..._shared import filesystem as fs, configuration as cfg
+from ..._shared import configuration as cfg, filesystem as fs
 from ...davult import models
-from ...filesystem.userspace import Userspace
+from ...filesystem.userspace import Userspace, userspaces
 
 
 limiter = Limiter(key_func=get_remote_address)
@@ -20,11 +24,11 @@ router = APIRouter(tags=[EndpointTags.filesystem])
 
 
 @router.get('/quota', summary="Get available space in user storage")
-def fs_quota(user: Annotated[models.User, Depends(auth_bearer)]):
-    userspace = Userspace(fs, user.id)
+def fs_quota(user: Annotated[models.User, Depends(auth_bearer_read)]):
+    userspace = userspaces.get(user.id)
 
     size = fs.get_userspace_size()
-    used = userspace.get_size('.')
+    used = userspace.get_usage()
 
     return {
         'data': {
@@ -38,40 +42,33 @@ def fs_quota(user: Annotated[models.User, Depends(auth_bearer)]):
 
 
 @router.get('/dir/get', summary="List the directory")
-def fs_dir_get(user: Annotated[models.User, Depends(auth_bearer)], path: Annotated[str, Depends(get_path)]):
-    userspace = Userspace(fs, user.id)
+def fs_dir_get(user: Annotated[models.User, Depends(auth_bearer_read)], path: Annotated[str, Depends(get_path)]):
+    userspace = userspaces.get(user.id)
 
     try:
-        files, directories = userspace.listdir(path)
-    except (FileNotFoundError, ValueError):
+        scoped_path = userspace.normalize(path)
+        entries = userspace.scandir(path)
+    except (FileNotFoundError, NotADirectoryError, ValueError):
         raise HTTPException(status_code=404, detail="path not found")
 
-    # base_path = userspace.get_root()
-
-    _deep_adapt = lambda path: Path() / cfg['storage']['root'] / cfg['storage']['filesystem'] / _adapt(path)
-    _adapt = lambda path: Path(str(user.id)) / path
-    _norm = lambda path: Path(_deep_adapt(path)).resolve().relative_to(userspace._root.absolute())
-    _scope = lambda path, level: (path := _norm(path)).relative_to(path.parents[-level])
-
     return {
         'valid': True,
         'data': {
             'name': Path(path).name,
-            'scopedPath': str(_norm(path)),
+            'scopedPath': str(scoped_path),
             'files': [{
-                'filename': file.name,
-                'scopedPath': _scope(file, 3),
-                # FIXME wtf
-                'size': userspace._fs.get_size(_adapt(_scope(_adapt(file), 4))),
-                'mime': userspace._fs.get_mime(_adapt(_scope(_adapt(file), 4))),
+                'filename': entry.name,
+                'scopedPath': str(scoped_path / entry.name),
+                'size': entry.size,
+                'mime': entry.mime,
                 # on linux file creation timestamp is a bit broky, more precisely it shows last metadata modification
-                'dateCreated': adapt_timestamp((stat := userspace.get_stat(_scope(_adapt(file), 4))).st_ctime),
-                'dateModified': adapt_timestamp(stat.st_mtime)
-            } for file in files],
+                'dateCreated': adapt_timestamp(entry.created),
+                'dateModified': adapt_timestamp(entry.modified)
+            } for entry in entries if not entry.is_directory],
             'directories': [{
-                'name': Path(directory).name,
-                'scopedPath': _scope(directory, 3)
-            } for directory in directories]
+                'name': entry.name,
+                'scopedPath': str(scoped_path / entry.name)
+            } for entry in entries if entry.is_directory]
         }
     }
 
@@ -79,7 +76,7 @@ def fs_dir_get(user: Annotated[models.User, Depends(auth_bearer)], path: Annotat
 @router.get('/dir/create', summary="Create the directory")
 @limiter.limit("3/second")
 def fs_dir_create(request: Request, user: Annotated[models.User, Depends(auth_bearer)], path: Annotated[str, Depends(get_path)]):
-    userspace = Userspace(fs, user.id)
+    userspace = userspaces.get(user.id)
 
     try:
         userspace.mkdir(path)
@@ -92,29 +89,41 @@ def fs_dir_create(request: Request, user: Annotated[models.User, Depends(auth_be
 
 
 @router.get('/file/get', summary="Read the file")
-def fs_file_get(response: Response, user: Annotated[models.User, Depends(auth_bearer)], path: Annotated[str, Depends(get_path)]):
-    userspace = Userspace(fs, user.id)
+def fs_file_get(user: Annotated[models.User, Depends(auth_bearer_read)], path: Annotated[str, Depends(get_path)]):
+    userspace = userspaces.get(user.id)
 
     try:
-        response.headers['Content-Type'] = userspace.get_mime(path)
-        response.body = userspace.read(path)
-    except (FileNotFoundError, ValueError):
+        file = userspace.open_read(path)
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError, ValueError):
         raise HTTPException(status_code=404, detail="path not found")
 
-    response.status_code = 200
+    # the validator headers and the size come from the opened file, not from whatever is at its path by now
+    if not stat.S_ISREG((file_stat := os.fstat(file.fileno())).st_mode):
+        file.close()
+        raise HTTPException(status_code=404, detail="path not found")
 
-    return response
+    return RangeFileResponse(file, path, headers={'Content-Type': userspace.get_mime(path)}, stat_result=file_stat)
 
 
 @router.post('/file/write', summary="Write to the file")
 @limiter.limit("3/second")
 async def fs_file_write(request: Request, user: Annotated[models.User, Depends(auth_bearer)], path: Annotated[str, Depends(get_path)]):
-    file_data = await request.body()
-
-    userspace = Userspace(fs, user.id)
+    # all of the disk work (setting up the userspace, measuring its usage, writing) is kept off the event loop
+    userspace = await run_in_threadpool(userspaces.get, user.id)
 
     try:
-        userspace.write(path, file_data)
+        upload = await run_in_threadpool(userspace.upload, path)
+
+        try:
+            if (length := request.headers.get('content-length', '')).isdigit():
+                await run_in_threadpool(upload.reserve, int(length))
+
+            async for chunk in request.stream():
+                await run_in_threadpool(upload.write, chunk)
+
+            await run_in_threadpool(upload.commit)
+        finally:
+            await run_in_threadpool(upload.discard)
     except (FileNotFoundError, ValueError):
         raise HTTPException(status_code=404, detail="path not found")
     except RuntimeError:
@@ -126,7 +135,7 @@ async def fs_file_write(request: Request, user: Annotated[models.User, Depends(a
 def fs_time_copy(request: Request, user: Annotated[models.User, Depends(auth_bearer)], path: Annotated[str, Depends(get_path)], target: str):
     target = base64.b64decode(target).decode('utf-8')
 
-    userspace = Userspace(fs, user.id)
+    userspace = userspaces.get(user.id)
 
     try:
         userspace.copy(path, target)
@@ -139,7 +148,7 @@ def fs_time_copy(request: Request, user: Annotated[models.User, Depends(auth_bea
 @router.get('/rm', summary="Delete the file or the directory")
 @limiter.limit("3/second")
 def fs_rm(request: Request, user: Annotated[models.User, Depends(auth_bearer)], path: Annotated[str, Depends(get_path)]):
-    userspace = Userspace(fs, user.id)
+    userspace = userspaces.get(user.id)
 
     try:
         userspace.remove(path)
@@ -152,18 +161,129 @@ def fs_rm(request: Request, user: Annotated[models.User, Depends(auth_bearer)],
 def fs_item_rename(request: Request, user: Annotated[models.User, Depends(auth_bearer)], oldpath: str, newpath: str):
     _b64 = lambda s: base64.b64decode(s).decode('utf-8')  # NOQA E731
 
-    userspace = Userspace(fs, user.id)
+    userspace = userspaces.get(user.id)
 
     try:
         userspace.move(_b64(oldpath), _b64(newpath))
     except (FileNotFoundError, ValueError):
         raise HTTPException(status_code=404, detail="path not found")
+    except FileExistsError:
+        raise HTTPException(status_code=409)
+
+
+def get_batch(request: Request, batch: FilesystemBatch) -> FilesystemBatch:
+    if len(batch.operations) > cfg['filesystem']['batch']['max_operations']:
+        raise HTTPException(status_code=413, detail="too many operations")
+
+    # the rate limit is checked after the dependencies are solved, so it can charge for every operation
+    request.state.batch_cost = max(len(batch.operations), 1)
+
+    return batch
+
+
+@router.post('/batch', summary="Run a list of filesystem operations in order")
+@limiter.limit(cfg['filesystem']['batch']['rate_limit'], cost=lambda request: request.state.batch_cost)
+def fs_batch(request: Request, user: Annotated[models.User, Depends(auth_bearer)], batch: Annotated[FilesystemBatch, Depends(get_batch)], dry_run: bool = False):
+    userspace = userspaces.get(user.id)
+
+    for index, operation in enumerate(batch.operations):
+        if operation.op in ('cp', 'rename') and operation.target is None:
+            raise HTTPException(status_code=422, detail=f"operation {index} has no target")
+
+        try:
+            for path in (operation.path, operation.target):
+                if path is not None:
+                    userspace.normalize(path)
+        except ValueError:
+            raise HTTPException(status_code=404, detail=f"path not found (operation {index})")
+
+    if dry_run:
+        required = _estimate_usage(userspace, batch.operations)
+        free = fs.get_userspace_size() - userspace.get_usage()
+
+        if required > free:
+            raise HTTPException(status_code=413, detail="data is too large (not enough space)")
+
+        return {'valid': True, 'data': {'required': required, 'free': free}}
+
+    results = []
+
+    for operation in batch.operations:
+        # the operations may depend on each other, so the rest is skipped after a failure
+        if results and results[-1]['statusCode'] != 200:
+            results.append({'statusCode': 424, 'detail': "previous operation failed"})
+            continue
+
+        try:
+            _run_operation(userspace, operation)
+            results.append({'statusCode': 200})
+        except (FileNotFoundError, ValueError):
+            results.append({'statusCode': 404, 'detail': "path not found"})
+        except (FileExistsError, IsADirectoryError, NotADirectoryError):
+            results.append({'statusCode': 409})
+        except RuntimeError:
+            results.append({'statusCode': 413, 'detail': "data is too large (not enough space)"})
+
+    return {'valid': all(result['statusCode'] == 200 for result in results), 'data': results}
+
+
+def _run_operation(userspace: Userspace, operation: FilesystemOperation):
+    match operation.op:
+        case 'dir/create':
+            userspace.mkdir(operation.path)
+        case 'file/write':
+            userspace.write(operation.path, operation.data)
+        case 'cp':
+            userspace.copy(operation.path, operation.target)
+        case 'rm':
+            userspace.remove(operation.path)
+        case 'rename':
+            userspace.move(operation.path, operation.target)
+
+
+def _estimate_usage(userspace: Userspace, operations: list[FilesystemOperation]) -> int:
+    # peak of the space taken along the way, as every operation reserves it before the next one frees any
+    usage = peak = 0
+    # charged sizes of the files as the batch leaves them, `None` for what it removes
+    files: dict[Path, int | None] = {}
+
+    def get_size(path: str, files_only: bool = False) -> int:
+        if (normalized := userspace.normalize(path)) in files:
+            return files[normalized] or 0
+
+        try:
+            is_file = stat.S_ISREG(userspace.get_stat(path).st_mode)
+        except (FileNotFoundError, NotADirectoryError):
+            return 0
+
+        # the same as the ledger is charged, shared (template) files cost nothing to copy nor free anything
+        return userspace.get_size(path) if is_file or not files_only else 0
+
+    for operation in operations:
+        match operation.op:
+            case 'file/write':
+                usage += len(operation.data) - get_size(operation.path, files_only=True)
+                files[userspace.normalize(operation.path)] = len(operation.data)
+            case 'cp':
+                usage += (size := get_size(operation.path)) - get_size(operation.target, files_only=True)
+                files[userspace.normalize(operation.target)] = size
+            case 'rm':
+                usage -= get_size(operation.path)
+                files[userspace.normalize(operation.path)] = None
+            case 'rename':
+                usage -= get_size(operation.target, files_only=True)
+                files[userspace.normalize(operation.target)] = get_size(operation.path)
+                files[userspace.normalize(operation.path)] = None
+
+        peak = max(peak, usage)
+
+    return peak
 
 
 @router.get('/tree', summary="Get the tree of the userspace")
 @limiter.limit("5/second")
-def fs_tree(request: Request, user: Annotated[models.User, Depends(auth_bearer)]):
-    userspace = Userspace(fs, user.id)
+def fs_tree(request: Request, user: Annotated[models.User, Depends(auth_bearer_read)]):
+    userspace = userspaces.get(user.id)
 
     try:
         paths = userspace.get_tree(".")
@@ -4,10 +4,11 @@ from typing import Annotated
 from fastapi import APIRouter, Depends, HTTPException
 from slowapi import Limiter
 from slowapi.util import get_remote_address
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from starlette.requests import Request
 
-from ._common import get_db, auth_bearer, adapt_timestamp
+from ._common import get_db, get_async_db, get_async_read_db, auth_bearer, auth_bearer_async, auth_bearer_read, adapt_timestamp
 from .. import EndpointTags
 from ...davult import models, schemas
 from ...davult.crud import message as msg_db, user as user_db
@@ -26,15 +27,40 @@ def get_id(id: str) -> int:
         raise HTTPException(status_code=422, detail="your id is invalid")
 
 
-def get_target(db: Annotated[Session, Depends(get_db)], target: str) -> models.User:
-    return user_db.find_user(db, base64.b64decode(target).decode('utf-8'))
+def get_message(db: Session, user: models.User, id: int, sent_only: bool = False) -> models.Message:
+    try:
+        message = msg_db.get_message(db, id)
+    except LookupError:
+        raise HTTPException(status_code=404)
+
+    return check_access(message, user, sent_only)
+
+
+async def get_message_async(db: AsyncSession, user: models.User, id: int) -> models.Message:
+    try:
+        message = await msg_db.get_message_async(db, id)
+    except LookupError:
+        raise HTTPException(status_code=404)
+
+    return check_access(message, user)
+
+
+def check_access(message: models.Message, user: models.User, sent_only: bool = False) -> models.Message:
+    if not (message.sender_id == user.id if sent_only else msg_db.is_participant(message, user.id)):
+        raise HTTPException(status_code=403)
+
+    return message
+
+
+async def get_target(db: Annotated[AsyncSession, Depends(get_async_db)], target: str) -> models.User:
+    return await user_db.find_user_async(db, base64.b64decode(target).decode('utf-8'))
 
 
 @router.post('/send', summary="Send the message")
 @limiter.limit("1/second")
-async def messages_send(request: Request, db: Annotated[Session, Depends(get_db)], user: Annotated[models.User, Depends(auth_bearer)], target: Annotated[models.User, Depends(get_target)]):
+async def messages_send(request: Request, db: Annotated[AsyncSession, Depends(get_async_db)], user: Annotated[models.User, Depends(auth_bearer_async)], target: Annotated[models.User, Depends(get_target)]):
     try:
-        message = msg_db.send_message(db, schemas.MessageCreate(
+        message = await msg_db.send_message_async(db, schemas.MessageCreate(
             sender_id=user.id,
             receiver_id=target.id,
             body=(await request.body()).decode('utf-8')
@@ -54,9 +80,9 @@ async def messages_send(request: Request, db: Annotated[Session, Depends(get_db)
 
 @router.post('/reply', summary="Reply to the message")
 @limiter.limit("1/second")
-async def messages_reply(request: Request, db: Annotated[Session, Depends(get_db)], user: Annotated[models.User, Depends(auth_bearer)], id: int, target: Annotated[models.User, Depends(get_target)]):
+async def messages_reply(request: Request, db: Annotated[AsyncSession, Depends(get_async_db)], user: Annotated[models.User, Depends(auth_bearer_async)], id: int, target: Annotated[models.User, Depends(get_target)]):
     try:
-        message = msg_db.send_message(db, schemas.MessageCreate(
+        message = await msg_db.send_message_async(db, schemas.MessageCreate(
             sender_id=user.id,
             receiver_id=target.id,
             body=(await request.body()).decode('utf-8'),
@@ -77,16 +103,10 @@ async def messages_reply(request: Request, db: Annotated[Session, Depends(get_db
 
 
 @router.get('/get', summary="Get contents of the message")
-def messages_get(db: Annotated[Session, Depends(get_db)], user: Annotated[models.User, Depends(auth_bearer)], id: Annotated[int, Depends(get_id)]):
-    try:
-        message = msg_db.get_message(db, id)
-    except LookupError:
-        raise HTTPException(status_code=404)
+async def messages_get(db: Annotated[AsyncSession, Depends(get_async_db)], user: Annotated[models.User, Depends(auth_bearer_async)], id: Annotated[int, Depends(get_id)]):
+    message = await get_message_async(db, user, id)
 
-    if message not in set(user.sent_messages + user.received_messages):
-        raise HTTPException(status_code=403)
-
-    msg_db.mark_read(db, message)
+    await msg_db.mark_read_async(db, message)
 
     return {
         'valid': True,
@@ -94,7 +114,7 @@ def messages_get(db: Annotated[Session, Depends(get_db)], user: Annotated[models
             'sender': message.sender.username,
             'receiver': message.receiver.username,
             'body': message.body,
-            'replies': [reply.id for reply in msg_db.get_replies(db, message)],
+            'replies': await msg_db.get_reply_ids_async(db, message),
             'replyingTo': message.replying_id,
             'timestamp': adapt_timestamp(message.sent_time.timestamp()),
             'id': message.id,
@@ -106,63 +126,63 @@ def messages_get(db: Annotated[Session, Depends(get_db)], user: Annotated[models
 @router.get('/delete', summary="Delete the message")
 @limiter.limit("1/second")
 def messages_delete(request: Request, db: Annotated[Session, Depends(get_db)], user: Annotated[models.User, Depends(auth_bearer)], id: Annotated[int, Depends(get_id)]):
-    try:
-        message = msg_db.get_message(db, id)
-    except LookupError:
-        raise HTTPException(status_code=404)
-
-    if message not in user.sent_messages:
-        raise HTTPException(status_code=403)
-
-    msg_db.delete_message(db, message)
+    msg_db.delete_message(db, get_message(db, user, id, sent_only=True))
 
 
 @router.get('/list', summary="Get all sent and received messages")
-def messages_list(user: Annotated[models.User, Depends(auth_bearer)], count: int = -1, offset: int = 0, descending: bool = True):
-    messages = list(set(user.sent_messages + user.received_messages))
-    messages.sort(key=msg_db.get_message_timestamp, reverse=descending)
+async def messages_list(db: Annotated[AsyncSession, Depends(get_async_read_db)], user: Annotated[models.User, Depends(auth_bearer_read)], count: int = -1, offset: int = 0, descending: bool = True,
+                        before: str | None = None, after: str | None = None):
+    try:
+        before, after = (msg_db.decode_cursor(cursor) if cursor is not None else None for cursor in (before, after))
+    except (ValueError, OverflowError):
+        raise HTTPException(status_code=422, detail="your cursor is invalid")
+
+    messages = await msg_db.list_messages_async(db, user.id, MESSAGE_PREVIEW_BODY_LEN, count, offset, descending, before, after)
 
     return {
         'valid': True,
         'data': [{
-            'sender': message.sender.username,
-            'receiver': message.receiver.username,
-            'partialBody': message.body[:MESSAGE_PREVIEW_BODY_LEN],
+            'sender': message.sender,
+            'receiver': message.receiver,
+            'partialBody': message.partial_body,
             'timestamp': adapt_timestamp(message.sent_time.timestamp()),
             'replyingTo': message.replying_id,
             'id': message.id,
             'read': message.is_read
-        } for message in messages[offset:(count + offset) if count != -1 else None] if not message.is_deleted]
+        } for message in messages],
+        # pass as `before` (or `after` when ascending) to get the next page
+        'next': msg_db.encode_cursor((last := messages[-1]).sent_time, last.id) if messages else None
     }
 
 
-def _get_thread_root(db: Session, message: models.Message) -> models.Message:
-    return _get_thread_root(db, msg_db.get_message(db, reply_id)) if (reply_id := message.replying_id) else message
+def _build_thread(messages: list) -> dict:
+    nodes = {}
+
+    for message in messages:
+        nodes[message.id] = {
+            'sender': message.sender,
+            'receiver': message.receiver,
+            'partialBody': message.partial_body,
+            'replies': [],
+            'replyingTo': message.replying_id,
+            'timestamp': adapt_timestamp(message.sent_time.timestamp()),
+            'id': message.id,
+        }
 
+        # the root is always first and the parents always come before their replies
+        if (parent := nodes.get(message.replying_id)) is not None:
+            parent['replies'].append(nodes[message.id])
 
-def _expand_message_replies(db: Session, user: models.User, message: models.Message) -> dict:
-    return {
-        'sender': message.sender.username,
-        'receiver': message.receiver.username,
-        'partialBody': message.body[:MESSAGE_PREVIEW_BODY_LEN],
-        'replies': [_expand_message_replies(db, user, reply) for reply in msg_db.get_replies(db, message) if reply in set(user.sent_messages + user.received_messages)],
-        'replyingTo': message.replying_id,
-        'timestamp': adapt_timestamp(message.sent_time.timestamp()),
-        'id': message.id,
-    }
+    return nodes[messages[0].id]
 
 
 @router.get('/thread', summary="Get the thread")
-def messages_thread(db: Annotated[Session, Depends(get_db)], user: Annotated[models.User, Depends(auth_bearer)], id: Annotated[int, Depends(get_id)]):
-    message = msg_db.get_message(db, id)
-
-    if message not in set(user.sent_messages + user.received_messages):
-        raise HTTPException(status_code=403)
+async def messages_thread(db: Annotated[AsyncSession, Depends(get_async_read_db)], user: Annotated[models.User, Depends(auth_bearer_read)], id: Annotated[int, Depends(get_id)]):
+    message = await get_message_async(db, user, id)
 
-    root_message = _get_thread_root(db, message)
-    thread = _expand_message_replies(db, user, root_message)
+    thread = await msg_db.get_thread_async(db, await msg_db.get_thread_root_id_async(db, message.id), user.id, MESSAGE_PREVIEW_BODY_LEN)
 
     return {
         'valid': True,
-        'data': thread
+        'data': _build_thread(thread)
     }
@@ -1,16 +1,16 @@
 from typing import Annotated
 
 from fastapi import APIRouter, Header, HTTPException, Depends, Request
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 
 
-from ._common import auth_basic, get_db
+from ._common import auth_basic, get_db, get_async_db
 from .. import EndpointTags
 from ..._shared import configuration as cfg
 from ...davult import schemas
-from ...davult.models import is_enabled
 from ...davult.crud import token as token_db, user as user_db
 
 
@@ -20,23 +20,23 @@ router = APIRouter(tags=[EndpointTags.sessions])
 
 @router.get('/auth', summary="Create session")
 @limiter.limit("15/minute")
-def auth(request: Request, db: Annotated[Session, Depends(get_db)], credentials: Annotated[tuple[str, str], Depends(auth_basic)]):
+async def auth(request: Request, db: Annotated[AsyncSession, Depends(get_async_db)], credentials: Annotated[tuple[str, str], Depends(auth_basic)]):
     username, password = credentials
 
     try:
-        user = user_db.find_user(db, username)
+        user = await user_db.find_user_async(db, username)
     except LookupError:
         raise HTTPException(status_code=404, detail="user not found")
 
-    if not is_enabled(user):
+    if not user.is_enabled:
         raise HTTPException(status_code=403, detail="user is disabled")
 
     try:
-        token = token_db.generate_token(db, schemas.TokenCreate(
+        token = await token_db.generate_token_async(db, schemas.TokenCreate(
             owner_id=user.id,
             password=password,
             lifetime=cfg['security']['token_lifetime']
-        ))
+        ), cfg['security']['max_sessions'])
     except ValueError:
         raise HTTPException(status_code=403, detail="invalid credentials")
 
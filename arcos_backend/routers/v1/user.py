@@ -2,19 +2,21 @@ import base64
 import json
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Header, Query, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from starlette.requests import Request
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 
-from ._common import auth_basic, auth_bearer, get_db
+from ._common import auth_basic, auth_bearer, auth_bearer_async, auth_bearer_read, get_db, get_async_db
 from .. import EndpointTags
-from ..._shared import filesystem as fs
-from ..._utils import MAX_USERNAME_LEN
+from ..._jsonpatch import apply_patch, parse_pointer, resolve_pointer
 from ...davult import schemas, models
+from ...davult.buffer import properties_buffer
 from ...davult.crud import user as user_db
-from ...filesystem.userspace import Userspace
+from ...filesystem.userspace import userspaces
 
 
 limiter = Limiter(key_func=get_remote_address)
@@ -23,44 +25,115 @@ router = APIRouter(tags=[EndpointTags.users])
 
 @router.get('/create', summary="Create new user")
 @limiter.limit("7/hour")
-def user_create(request: Request, db: Annotated[Session, Depends(get_db)], credentials: Annotated[tuple[str, str], Depends(auth_basic)]):
+async def user_create(request: Request, db: Annotated[AsyncSession, Depends(get_async_db)], credentials: Annotated[tuple[str, str], Depends(auth_basic)]):
     username, password = credentials
 
     try:
-        user = user_db.create_user(db, schemas.UserCreate(
+        user = await user_db.create_user_async(db, schemas.UserCreate(
             username=username, password=password))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except RuntimeError:
         raise HTTPException(status_code=409, detail="username already exists")
 
-    Userspace(fs, user.id)
+    await run_in_threadpool(userspaces.get, user.id)
 
     return {'valid': True}
 
 
-@router.get('/properties', summary="Get user properties")
-def user_properties(user: Annotated[models.User, Depends(auth_bearer)]):
-    return {**json.loads(user.properties), 'valid': True, 'statusCode': 200}
+def get_properties_etag(version: int) -> str:
+    return f'"{version}"'
+
+
+@router.get('/properties', summary="Get user properties, or only the subtrees at the given JSON pointers")
+async def user_properties(response: Response, user: Annotated[models.User, Depends(auth_bearer_read)], if_none_match: Annotated[str | None, Header()] = None,
+                          pointer: Annotated[list[str] | None, Query()] = None):
+    properties, version = properties_buffer.get(user)
+    etag = get_properties_etag(version)
+
+    if if_none_match is not None and etag in if_none_match:
+        return Response(status_code=304, headers={'ETag': etag})
+
+    response.headers['ETag'] = etag
+
+    if pointer is None:
+        return {**properties, 'valid': True, 'statusCode': 200}
+
+    try:
+        return {'data': {path: resolve_pointer(properties, path) for path in pointer}, 'valid': True}
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
 
 
 # not rate limited because frontend spams this endpoint as hell
 @router.post('/properties/update', summary="Update user properties")
-async def user_properties_update(request: Request, db: Annotated[Session, Depends(get_db)], user: Annotated[models.User, Depends(auth_bearer)]):
+async def user_properties_update(request: Request, response: Response, user: Annotated[models.User, Depends(auth_bearer_async)]):
     try:
         properties = json.JSONDecoder().decode((await request.body()).decode('utf-8'))
     except json.JSONDecodeError:
         raise HTTPException(status_code=422)
 
-    user_db.update_user_properties(db, user, properties)
+    if not isinstance(properties, dict):
+        raise HTTPException(status_code=422, detail="properties have to be an object")
+
+    _, version = properties_buffer.update(user, properties)
+
+    # the `acc` section is seen by others (in the user directory), so it isn't held back
+    if 'acc' in properties or properties_buffer.is_write_through():
+        await run_in_threadpool(properties_buffer.flush, user.id)
+
+    response.headers['ETag'] = get_properties_etag(version)
+
+
+@router.patch('/properties', summary="Update user properties with a JSON patch (RFC 6902)")
+async def user_properties_patch(request: Request, response: Response, user: Annotated[models.User, Depends(auth_bearer_async)], if_match: Annotated[str | None, Header()] = None):
+    try:
+        operations = json.loads(await request.body())
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise HTTPException(status_code=422)
+
+    # without `If-Match` the patch applies to whatever version is the current one
+    expected_version = None
+    if if_match is not None and if_match.strip() != '*':
+        try:
+            expected_version = int(if_match.strip().removeprefix('W/').strip('"'))
+        except ValueError:
+            raise HTTPException(status_code=412, detail="unknown version")
+
+    def patch(properties: dict) -> dict:
+        if not isinstance(patched := apply_patch(properties, operations), dict):
+            raise ValueError("properties have to be an object")
+        return patched
+
+    try:
+        _, version = properties_buffer.modify(user, patch, expected_version)
+    except RuntimeError as e:
+        raise HTTPException(status_code=412, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except LookupError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    # a `move` changes where it's moved from too
+    pointers = [operation[key] for operation in operations for key in ('path', 'from') if key in operation]
+
+    if any(parse_pointer(pointer)[:1] in ([], ['acc']) for pointer in pointers) or properties_buffer.is_write_through():
+        await run_in_threadpool(properties_buffer.flush, user.id)
+
+    response.headers['ETag'] = get_properties_etag(version)
+
+    return {'valid': True}
 
 
 @router.get('/delete', summary="Delete the user")
 # @limiter.limit("17/hour")   # XXX rate limiting disabled due to admin endpoint relying on this, and we dont want to rate limit admin endpoint
 def user_delete(request: Request, db: Annotated[Session, Depends(get_db)], user: Annotated[models.User, Depends(auth_bearer)]):
-    userspace = Userspace(fs, user.id)
+    userspace = userspaces.get(user.id)
     user_db.delete_user(db, user)
     userspace.delete()
+    userspaces.discard(user.id)
 
 
 @router.get('/rename', summary="Change user's username")
@@ -68,22 +141,21 @@ def user_rename(db: Annotated[Session, Depends(get_db)], user: Annotated[models.
     newname = base64.b64decode(newname).decode('utf-8')
     try:
         user_db.rename_user(db, user, newname)
-    except ValueError:
-        raise HTTPException(
-            status_code=413, detail=f"username is too long (>{MAX_USERNAME_LEN})")
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
 
 
 @router.get('/changepswd', summary="Change user's password")
-def user_changepswd(db: Annotated[Session, Depends(get_db)], credentials: Annotated[tuple[str, str], Depends(auth_basic)], new: str):
+async def user_changepswd(db: Annotated[AsyncSession, Depends(get_async_db)], credentials: Annotated[tuple[str, str], Depends(auth_basic)], new: str):
     new = base64.b64decode(new).decode('utf-8')
     username, password = credentials
 
     try:
-        user = user_db.find_user(db, username)
+        user = await user_db.find_user_async(db, username)
     except LookupError:
         raise HTTPException(status_code=404)
 
-    if not user_db.validate_credentials(user, password):
+    if not await user_db.validate_credentials_async(db, user, password):
         raise HTTPException(status_code=403)
 
-    user_db.set_user_password(db, user_db.find_user(db, username), new)
+    await user_db.set_user_password_async(db, user, new)
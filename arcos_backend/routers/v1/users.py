@@ -1,26 +1,26 @@
-import json
 from typing import Annotated
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Header, Response
 from sqlalchemy.orm import Session
 
-from ._common import get_db
+from ._common import get_read_db
 from .. import EndpointTags
-from ...davult.models import is_enabled
-from ...davult.crud import user as user_db
+from ...davult.cache import user_directory
 
 
 router = APIRouter(tags=[EndpointTags.users])
 
 
 @router.get('/get', summary="Get the list of users")
-def users_get(db: Annotated[Session, Depends(get_db)]):
-    users = user_db.get_users(db)
+def users_get(response: Response, db: Annotated[Session, Depends(get_read_db)], if_none_match: Annotated[str | None, Header()] = None, count: int = -1, offset: int = 0):
+    users, etag = user_directory.get(db)
+
+    if if_none_match is not None and etag in if_none_match:
+        return Response(status_code=304, headers={'ETag': etag})
+
+    response.headers['ETag'] = etag
 
     return {
-        'data': sorted([{
-            'username': user.username,
-            'acc': json.loads(user.properties)['acc']
-        } for user in users if not user.is_deleted and is_enabled(user)], key=lambda item: item['username']),
+        'data': users[offset:(count + offset) if count != -1 else None],
         'valid': True
     }
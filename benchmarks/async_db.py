@@ -0,0 +1,147 @@
+#!/bin/python
+# compares latency under 500 simultaneous clients of the former sync database path and the async one
+# run from the repository root: `python -m benchmarks.async_db`
+import asyncio
+import json
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Annotated
+
+import httpx
+from fastapi import FastAPI, Depends
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+from starlette.requests import Request
+
+from arcos_backend.davult import models, schemas
+from arcos_backend.davult.crud import message as msg_db, user as user_db
+from arcos_backend.davult.database import create_database_engine, create_async_database_engine
+from arcos_backend.routers.v1 import _common, messages, user
+
+
+CLIENTS = 500
+REQUESTS_PER_CLIENT = 2
+MESSAGES = 200
+# (size, overflow) - the default one, and one with a connection for every client
+POOLS = ((5, 10), (CLIENTS, 0))
+POOL_TIMEOUT = 10
+
+
+def add_legacy_routes(app: FastAPI):
+    # as the endpoints were before: sync handlers in the threadpool, and sync calls blocking the event loop in async ones
+    @app.get('/legacy/messages/list')
+    def legacy_list(db: Annotated[Session, Depends(_common.get_db)], user: Annotated[models.User, Depends(_common.auth_bearer)]):
+        return {'valid': True, 'data': [row.id for row in msg_db.list_messages(db, user.id, 30, 50)]}
+
+    @app.post('/legacy/user/properties/update')
+    async def legacy_update(request: Request, db: Annotated[Session, Depends(_common.get_db)], user: Annotated[models.User, Depends(_common.auth_bearer)]):
+        user_db.update_user_properties(db, user, json.loads(await request.body()))
+
+
+def create_app(database: str, pool_size: int, max_overflow: int) -> tuple[FastAPI, AsyncEngine]:
+    engine = create_database_engine(f"sqlite:///{database}", pool_size, max_overflow, POOL_TIMEOUT)
+    async_engine = create_async_database_engine(f"sqlite+aiosqlite:///{database}", pool_size, max_overflow, POOL_TIMEOUT)
+
+    LocalSession = sessionmaker(bind=engine)
+    AsyncLocalSession = async_sessionmaker(bind=async_engine, expire_on_commit=False)
+
+    def get_db():
+        with LocalSession() as db:
+            yield db
+
+    async def get_async_db():
+        async with AsyncLocalSession() as db:
+            yield db
+
+    app = FastAPI()
+    app.include_router(messages.router, prefix='/messages')
+    app.include_router(user.router, prefix='/user')
+    add_legacy_routes(app)
+
+    app.dependency_overrides = {
+        _common.get_db: get_db,
+        _common.get_read_db: get_db,
+        _common.get_async_db: get_async_db,
+        _common.get_async_read_db: get_async_db
+    }
+
+    return app, async_engine
+
+
+def populate(database: str) -> str:
+    engine = create_database_engine(f"sqlite:///{database}", 1, 0)
+    models.Base.metadata.create_all(bind=engine)
+
+    with sessionmaker(bind=engine)() as db:
+        sender = user_db.create_user(db, schemas.UserCreate(username=f"bench{uuid.uuid4().hex[:8]}", password="benchmark"))
+        receiver = user_db.create_user(db, schemas.UserCreate(username=f"bench{uuid.uuid4().hex[:8]}", password="benchmark"))
+
+        for i in range(MESSAGES):
+            msg_db.send_message(db, schemas.MessageCreate(sender_id=sender.id, receiver_id=receiver.id, body=f"message {i}"))
+
+        token = models.Token(value=str(uuid.uuid4()), owner_id=receiver.id, lifetime=3600,
+                             creation_time=datetime.utcnow(), expires_at=datetime.utcnow() + timedelta(hours=1))
+        db.add(token)
+        db.commit()
+
+        return token.value
+
+
+async def measure(app: FastAPI, token: str, method: str, path: str, body: bytes | None = None) -> tuple[list[float], int]:
+    latencies = []
+    failures = 0
+    headers = {'Authorization': f'Bearer {token}'}
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app, client=("127.0.0.1", 1)), base_url="http://arcapi", timeout=None) as client:
+        async def run_client():
+            nonlocal failures
+
+            for _ in range(REQUESTS_PER_CLIENT):
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, path, headers=headers, content=body)
+                except Exception:  # pool timeouts, which the transport reraises
+                    failures += 1
+                    continue
+
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    failures += 1
+
+        await asyncio.gather(*(run_client() for _ in range(CLIENTS)))
+
+    return latencies, failures
+
+
+def report(name: str, latencies: list[float], failures: int):
+    latencies = sorted(latencies) or [float('nan')]
+    percentile = lambda p: latencies[int(len(latencies) * p)] * 1000  # NOQA E731
+
+    print(f"{name:>40}: p50 {percentile(0.5):7.1f}ms  p99 {percentile(0.99):7.1f}ms  max {latencies[-1] * 1000:7.1f}ms  "
+          f"failed {failures}/{CLIENTS * REQUESTS_PER_CLIENT}")
+
+
+async def main(database: str):
+    token = populate(database)
+    update = json.dumps({'benchmark': True}).encode()
+
+    print(f"{CLIENTS} clients, {REQUESTS_PER_CLIENT} requests each, pool timeout {POOL_TIMEOUT}s")
+    for pool_size, max_overflow in POOLS:
+        app, async_engine = create_app(database, pool_size, max_overflow)
+
+        for name, method, path, body in (('sync  GET /messages/list', 'GET', '/legacy/messages/list', None),
+                                         ('async GET /messages/list', 'GET', '/messages/list?count=50', None),
+                                         ('sync  POST /user/properties/update', 'POST', '/legacy/user/properties/update', update),
+                                         ('async POST /user/properties/update', 'POST', '/user/properties/update', update)):
+            report(f"{name} ({pool_size + max_overflow} conn.)", *await measure(app, token, method, path, body))
+
+        # aiosqlite's connection threads would keep the interpreter alive
+        await async_engine.dispose()
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(main(os.path.join(directory, 'bench.sqlite')))
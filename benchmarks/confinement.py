@@ -0,0 +1,57 @@
+#!/bin/python
+# compares reading a deeply nested file checked with `resolve()` against opening it through directory descriptors
+# run from the repository root: `python -m benchmarks.confinement`
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from arcos_backend.filesystem import confine
+
+
+DEPTH = 20
+REQUESTS = 10_000
+ROUNDS = 5
+
+
+def read_resolved(root: Path, path: str) -> bytes:
+    if not (resolved := root.joinpath(path).resolve()).is_relative_to(root):
+        raise ValueError("path breaks out of the filesystem")
+
+    return resolved.read_bytes()
+
+
+def read_confined(root_fd: int, path: str) -> bytes:
+    with confine.parent_directory(root_fd, path) as (dir_fd, name):
+        fd = os.open(name, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=dir_fd)
+
+    with open(fd, 'rb') as file:
+        return file.read()
+
+
+def measure(function, *args) -> float:
+    timings = []
+
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        for _ in range(REQUESTS):
+            function(*args)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings) / REQUESTS
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as root:
+        root = Path(root).resolve()
+        path = os.path.join(*(f'level{i}' for i in range(DEPTH)), 'file.txt')
+
+        root.joinpath(path).parent.mkdir(parents=True)
+        root.joinpath(path).write_bytes(b'ArcOS')
+
+        root_fd = os.open(root, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+
+        for name, function, argument in (('resolve', read_resolved, root), ('confined', read_confined, root_fd)):
+            print(f"{name:>8}: {measure(function, argument, path) * 1_000_000:.1f}us per read, {DEPTH} levels deep")
+
+        os.close(root_fd)
@@ -0,0 +1,50 @@
+#!/bin/python
+# compares the per-entry listing `/fs/dir/get` used to do with the single-pass `scandir` one
+# run from the repository root: `python -m benchmarks.dir_listing`
+import tempfile
+import time
+from pathlib import Path
+
+from arcos_backend.filesystem import Filesystem
+from arcos_backend.filesystem.userspace import Userspace
+
+
+ENTRIES = 10_000
+ROUNDS = 5
+
+
+def list_per_entry(userspace: Userspace, path: str):
+    files, directories = userspace.listdir(path)
+
+    return [(userspace.normalize(file := f'{path}/{child.name}'),
+             userspace.get_size(file),
+             userspace.get_mime(file),
+             (stat := userspace.get_stat(file)).st_ctime,
+             stat.st_mtime) for child in files], [directory.name for directory in directories]
+
+
+def list_scandir(userspace: Userspace, path: str):
+    return userspace.scandir(path)
+
+
+def measure(function, *args) -> float:
+    timings = []
+
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as root:
+        userspace = Userspace(Filesystem(Path(root, 'fs'), None, 2 ** 40), 1)
+
+        userspace.mkdir('bench')
+        for i in range(ENTRIES):
+            userspace.write(f'bench/file{i}.txt', b'ArcOS')
+
+        for name, function in (('per entry', list_per_entry), ('scandir', list_scandir)):
+            print(f"{name:>10}: {measure(function, userspace, 'bench') * 1000:.1f}ms for {ENTRIES} entries")
@@ -0,0 +1,73 @@
+#!/bin/python
+# compares requests per second on `/connect` through the middleware stack with and without `MetricsMiddleware`
+# run from the repository root: `python -m benchmarks.metrics`
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from arcos_backend._authentication import AuthCodeMiddleware
+from arcos_backend._limits import BodySizeLimitMiddleware
+from arcos_backend._logging import AccessLog, LoggingMiddleware
+from arcos_backend._metrics import MetricsMiddleware, metrics
+from arcos_backend.routers.v1 import meta
+
+
+REQUESTS = 5000
+CONCURRENCY = 50
+ROUNDS = 10
+
+
+def create_app(with_metrics: bool, access_log: AccessLog) -> FastAPI:
+    app = FastAPI()
+    app.include_router(meta.router)
+
+    app.add_middleware(AuthCodeMiddleware, authcode="benchmark")
+    app.add_middleware(BodySizeLimitMiddleware, limits={'/messages/send': 8192})
+    app.add_middleware(LoggingMiddleware, access_log=access_log)
+
+    if with_metrics:
+        app.add_middleware(MetricsMiddleware)
+
+    return app
+
+
+async def measure(app: FastAPI) -> float:
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app, client=("127.0.0.1", 1)), base_url="http://arcapi") as client:
+        async def request():
+            async with semaphore:
+                assert (await client.get('/connect')).status_code == 200
+
+        start = time.perf_counter()
+        await asyncio.gather(*(request() for _ in range(REQUESTS)))
+
+        return REQUESTS / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        access_log = AccessLog(os.path.join(directory, 'access.log'))
+        access_log.start()
+
+        apps = {'without': create_app(False, access_log), 'with': create_app(True, access_log)}
+        results = {name: 0.0 for name in apps}
+
+        # interleaved, so that both see the same machine noise
+        for _ in range(ROUNDS):
+            for name, app in apps.items():
+                results[name] = max(results[name], asyncio.run(measure(app)))
+
+        for name, rps in results.items():
+            print(f"{name:>7}: {rps:.0f} requests/s")
+        print(f"overhead: {(1 - results['with'] / results['without']) * 100:.1f}%")
+
+        start = time.perf_counter()
+        metrics.render()
+        print(f"  render: {(time.perf_counter() - start) * 1000:.2f}ms")
+
+        access_log.stop()
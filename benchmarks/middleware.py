@@ -0,0 +1,95 @@
+#!/bin/python
+# compares requests per second on `/connect` through the former `BaseHTTPMiddleware` stack and the ASGI one
+# run from the repository root: `python -m benchmarks.middleware`
+import asyncio
+import logging
+import logging.handlers
+import os
+import queue
+import tempfile
+import time
+
+import httpx
+from fastapi import FastAPI
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import Response
+
+from arcos_backend._authentication import AuthCodeMiddleware
+from arcos_backend._limits import BodySizeLimitMiddleware
+from arcos_backend._logging import AccessLog, LoggingMiddleware
+from arcos_backend.routers.v1 import meta
+
+
+REQUESTS = 5000
+CONCURRENCY = 50
+
+
+class LegacyAuthCodeMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, authcode: str):
+        super().__init__(app)
+        self._authcode = authcode
+
+    async def dispatch(self, request, call_next):
+        if self._authcode is not None and request.scope['path'] != '/connect':
+            params = request.query_params
+            if 'ac' not in params or params['ac'] != self._authcode:
+                return Response(status_code=401)
+
+        return await call_next(request)
+
+
+class LegacyLoggingMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, filename: str):
+        super().__init__(app)
+
+        logging_queue = queue.Queue()
+        self._logger = logging.getLogger("arcos_backend.legacy")
+        self._logger.setLevel(logging.INFO)
+        self._logger.addHandler(logging.handlers.QueueHandler(logging_queue))
+        logging.handlers.QueueListener(logging_queue, logging.FileHandler(filename)).start()
+
+    async def dispatch(self, request, call_next):
+        start = time.perf_counter()
+        response = await call_next(request)
+        self._logger.info(f"{(c := request.client)[0]}:{c[1]} - {request.method} {request.url.path} - "
+                          f"{response.status_code} - {(time.perf_counter() - start) * 1000:.2f}ms")
+        return response
+
+
+def create_app(legacy: bool, log_filename: str) -> FastAPI:
+    app = FastAPI()
+    app.include_router(meta.router)
+
+    if legacy:
+        app.add_middleware(LegacyAuthCodeMiddleware, authcode="benchmark")
+        app.add_middleware(LegacyLoggingMiddleware, filename=log_filename)
+    else:
+        access_log = AccessLog(log_filename)
+        access_log.start()
+
+        app.add_middleware(AuthCodeMiddleware, authcode="benchmark")
+        app.add_middleware(BodySizeLimitMiddleware, limits={'/messages/send': 8192})
+        app.add_middleware(LoggingMiddleware, access_log=access_log)
+
+    return app
+
+
+async def measure(app: FastAPI) -> float:
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app, client=("127.0.0.1", 1)), base_url="http://arcapi") as client:
+        async def request():
+            async with semaphore:
+                assert (await client.get('/connect')).status_code == 200
+
+        start = time.perf_counter()
+        await asyncio.gather(*(request() for _ in range(REQUESTS)))
+
+        return REQUESTS / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        for name, legacy in (('before', True), ('after', False)):
+            rps = asyncio.run(measure(create_app(legacy, os.path.join(directory, f'{name}.log'))))
+            print(f"{name:>7}: {rps:.0f} requests/s")
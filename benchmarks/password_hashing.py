@@ -0,0 +1,40 @@
+#!/bin/python
+# reports how many password verifications (i.e. `/auth` calls) per second each scrypt cost setting allows
+# run from the repository root: `python -m benchmarks.password_hashing`
+import asyncio
+import time
+
+from arcos_backend._utils import PasswordHasher, hash_salty
+
+
+COSTS = [(2 ** 12, 8, 1), (2 ** 14, 8, 1), (2 ** 15, 8, 1), (2 ** 16, 8, 1)]
+WORKERS = 2
+VERIFICATIONS = 64
+
+
+async def measure(verify) -> float:
+    start = time.perf_counter()
+
+    # issued concurrently, like the requests awaiting them would be
+    assert all(await asyncio.gather(*(verify() for _ in range(VERIFICATIONS))))
+
+    return VERIFICATIONS / (time.perf_counter() - start)
+
+
+async def verify_legacy(hashed_password: str) -> bool:
+    return hashed_password == hash_salty('hunter2')
+
+
+async def verify_scrypt(hasher: PasswordHasher, hashed_password: str) -> bool:
+    return (await hasher.verify(hashed_password, 'hunter2'))[0]
+
+
+if __name__ == '__main__':
+    legacy_hash = hash_salty("hunter2")
+    print(f"{'legacy sha512':>22}: {asyncio.run(measure(lambda: verify_legacy(legacy_hash))):.1f} auth/s")
+
+    for n, r, p in COSTS:
+        hasher = PasswordHasher(n, r, p, WORKERS)
+        hashed_password = asyncio.run(hasher.hash("hunter2"))
+
+        print(f"{f'scrypt n={n} r={r} p={p}':>22}: {asyncio.run(measure(lambda: verify_scrypt(hasher, hashed_password))):.1f} auth/s")
@@ -0,0 +1,33 @@
+#!/bin/python
+# compares the precompiled profanity matcher with the double library check it replaced
+# run from the repository root: `python -m benchmarks.profanity`
+import random
+import string
+import time
+
+from better_profanity import profanity as better_profanity
+from profanity import profanity
+
+from arcos_backend._profanity import profanity_matcher
+
+
+USERNAMES = 1000
+
+
+def measure(check, usernames: list[str]) -> float:
+    start = time.perf_counter()
+
+    for username in usernames:
+        check(username)
+
+    return (time.perf_counter() - start) / len(usernames)
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    usernames = [''.join(random.choices(string.ascii_letters + string.digits + '_', k=random.randint(3, 25)))
+                 for _ in range(USERNAMES)]
+
+    for name, check in (('libraries', lambda username: profanity.contains_profanity(username) or better_profanity.contains_profanity(username)),
+                        ('matcher', profanity_matcher.contains_profanity)):
+        print(f"{name:>10}: {measure(check, usernames) * 1_000_000:.1f}us per username")
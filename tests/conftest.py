@@ -0,0 +1,19 @@
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+# the app sets itself up (config, storage, database) in the working directory once it's imported,
+# so the tests run in a scratch one
+ROOT = Path(__file__).resolve().parent.parent
+DIRECTORY = tempfile.mkdtemp(prefix='arcapi-tests-')
+
+os.symlink(ROOT.joinpath('arcos_backend'), Path(DIRECTORY, 'arcos_backend'))
+os.chdir(DIRECTORY)
+sys.path.insert(0, str(ROOT))
+
+
+def pytest_sessionfinish():
+    os.chdir(ROOT)
+    shutil.rmtree(DIRECTORY, ignore_errors=True)
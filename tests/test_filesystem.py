@@ -0,0 +1,74 @@
+import errno
+import os
+
+import pytest
+
+from arcos_backend.filesystem import Filesystem
+from arcos_backend.filesystem.userspace import Userspace
+
+
+@pytest.fixture
+def userspace(tmp_path) -> Userspace:
+    return Userspace(Filesystem(tmp_path.joinpath('fs'), None, 2 ** 20), 1)
+
+
+def test_root_is_not_removed(userspace):
+    userspace.mkdir('dir')
+    userspace.write('dir/file.txt', b'ArcOS' * 1000)
+
+    for path in ('.', '', 'dir/..'):
+        with pytest.raises(ValueError):
+            userspace.remove(path)
+
+    assert userspace.read('dir/file.txt') == b'ArcOS' * 1000
+    assert userspace.get_usage() == userspace.get_size('.') == 5000
+
+
+def test_root_is_not_escaped(userspace):
+    for path in ('..', '../1', '/etc/passwd'):
+        with pytest.raises(ValueError):
+            userspace.read(path)
+
+
+def test_opened_file_is_kept(userspace, tmp_path):
+    userspace.write('file.txt', b'ArcOS')
+    tmp_path.joinpath('secret.txt').write_bytes(b'secret')
+    os.symlink(tmp_path.joinpath('secret.txt'), userspace.get_root().joinpath('link.txt'))
+
+    with pytest.raises(ValueError):
+        userspace.open_read('link.txt')
+
+    with userspace.open_read('file.txt') as file:
+        # swapped for a symlink after being opened
+        userspace.get_root().joinpath('file.txt').unlink()
+        os.symlink(tmp_path.joinpath('secret.txt'), userspace.get_root().joinpath('file.txt'))
+
+        assert file.read() == b'ArcOS'
+
+
+def test_unlinked_shared_copies_are_charged(userspace, tmp_path, monkeypatch):
+    userspace.write('shared.txt', b'ArcOS' * 200)
+    # shared with something else, as the template files are
+    os.link(userspace.get_root().joinpath('shared.txt'), tmp_path.joinpath('other.txt'))
+    assert userspace.reconcile_usage() == 0
+
+    def link(*_, **__):
+        raise OSError(errno.EMLINK, "too many links")
+
+    monkeypatch.setattr(os, 'link', link)
+    userspace.copy('shared.txt', 'copy.txt')
+
+    assert userspace.get_usage() == userspace.get_size('.') == 1000
+
+
+def test_copy_into_directory_charges_the_overwritten_file(userspace):
+    userspace.mkdir('dir')
+    userspace.write('file.txt', b'A' * 100)
+    userspace.write('dir/file.txt', b'B' * 300)
+
+    userspace.copy('file.txt', 'dir')
+    userspace.write('moved.txt', b'C' * 50)
+    userspace.move('moved.txt', 'dir')
+
+    assert userspace.read('dir/file.txt') == b'A' * 100
+    assert userspace.get_usage() == userspace.get_size('.') == 250
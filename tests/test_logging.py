@@ -0,0 +1,13 @@
+from arcos_backend._logging import AccessLog
+
+
+def test_rotations_within_a_second_are_all_kept(tmp_path):
+    access_log = AccessLog(str(tmp_path.joinpath('access.log')), max_bytes=1, backups=10, batch_size=1, flush_interval=0.01)
+    access_log.start()
+
+    for i in range(5):
+        access_log.log({'request': i})
+
+    access_log.stop()
+
+    assert len(list(tmp_path.glob('access.log.*.gz'))) == 5
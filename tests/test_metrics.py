@@ -0,0 +1,22 @@
+import threading
+
+from arcos_backend._metrics import Counter, Histogram
+
+
+def run_in_threads(function, count: int):
+    for _ in range(count):
+        thread = threading.Thread(target=function)
+        thread.start()
+        thread.join()
+
+
+def test_finished_threads_are_folded():
+    counter = Counter("test_total", "", ('route',))
+    histogram = Histogram("test_seconds", "", ('route',), buckets=(1.0,))
+
+    run_in_threads(lambda: (counter.inc('/a'), histogram.observe(0.5, '/a')), 100)
+    counter.inc('/a')
+
+    assert len(counter._shards) == 1 and len(histogram._shards) == 0
+    assert counter.render() == ['test_total{route="/a"} 101']
+    assert 'test_seconds_count{route="/a"} 100' in histogram.render()
@@ -0,0 +1,55 @@
+import asyncio
+import base64
+import time
+
+import anyio.to_thread
+import httpx
+
+from arcos_backend import _utils, app, async_engine
+
+
+HASH_DURATION = 0.5
+
+
+def basic(username: str, password: str) -> dict:
+    return {'Authorization': 'Basic ' + base64.b64encode(f'{username}:{password}'.encode()).decode()}
+
+
+def slow_scrypt(*_) -> bytes:
+    time.sleep(HASH_DURATION)
+    return b'\0' * _utils.SCRYPT_HASH_LEN
+
+
+async def request_while_hashing() -> float:
+    # a single handler thread, which a hash waited for in a handler would hold all along
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 1
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://arcapi") as client:
+        creating = asyncio.gather(*(client.get('/user/create', headers=basic(f'hasher{i}', 'pw')) for i in range(3)))
+        await asyncio.sleep(HASH_DURATION / 5)
+
+        start = time.perf_counter()
+        assert (await client.get('/connect')).status_code == 200
+        elapsed = time.perf_counter() - start
+
+        assert all(response.status_code == 200 for response in await creating)
+
+    # its connections (and their threads) belong to this event loop
+    await async_engine.dispose()
+
+    return elapsed
+
+
+def test_requests_are_served_while_hashing(monkeypatch):
+    monkeypatch.setattr(_utils, '_scrypt', slow_scrypt)
+
+    assert asyncio.run(request_while_hashing()) < HASH_DURATION / 2
+
+
+def test_hash_round_trip():
+    hasher = _utils.PasswordHasher(2 ** 10, 8, 1, 1)
+    hashed_password = asyncio.run(hasher.hash('hunter2'))
+
+    assert asyncio.run(hasher.verify(hashed_password, 'hunter2')) == (True, False)
+    assert asyncio.run(hasher.verify(hashed_password, 'hunter3')) == (False, False)
+    assert asyncio.run(hasher.verify(_utils.hash_salty('hunter2'), 'hunter2')) == (True, True)
@@ -0,0 +1,22 @@
+from arcos_backend._profanity import profanity_matcher
+
+
+def test_leetspeak_wordlist_entries():
+    # entries spelled with digits and symbols themselves
+    for username in ('fux0r', 'v1gra', 'he11', 'masterbat*', 'xX_fux0r_Xx'):
+        assert profanity_matcher.contains_profanity(username), username
+
+
+def test_clean_usernames():
+    for username in ('alice', 'hello', 'shell', 'h3llo_w0rld'):
+        assert not profanity_matcher.contains_profanity(username), username
+
+
+def test_separators_end_substring_matches():
+    for username in ('ana_lee', 'ana.lee', 'ana-lee', 'ana.lewis', 'pen island', 'rcdldi_ckmu'):
+        assert not profanity_matcher.contains_profanity(username), username
+
+
+def test_separators_within_multi_word_entries():
+    for username in ('f u c k', 'f.u.c.k', 'blow_job', 'blow  job', 'xX_blow-job'):
+        assert profanity_matcher.contains_profanity(username), username